@@ -0,0 +1,386 @@
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+import httplib2
+import httpx
+import googleapiclient.errors
+
+from gmail_scheduler import METHOD_COSTS, DEFAULT_COST
+
+
+def http_error(status: int, reason: str):
+    content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}], 'message': reason}}).encode()
+    return googleapiclient.errors.HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeGmailServer:
+    """
+    In-process stand-in for the Gmail API. Every user has a mailbox with history, labels and messages.
+    Each HTTP round-trip sleeps @latency seconds (+-50% jitter), fails with probability @error_rate
+    (429 rateLimitExceeded or 503), and requests over @quota_units_per_second units per user are
+    answered with 429, like Gmail's per-user quota.
+    """
+
+    def __init__(self, latency: float = 0.02, error_rate: float = 0.0, quota_units_per_second: float = 250,
+                 seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_units_per_second = quota_units_per_second
+        self.random = random.Random(seed)
+        self.mailboxes = {}
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.calls = Counter()
+        self.http_requests = 0
+        self.errors = Counter()
+        self.units = 0
+        self._usage = defaultdict(list)
+
+    def mailbox(self, user_email: str):
+        if user_email not in self.mailboxes:
+            self.mailboxes[user_email] = FakeMailbox(self, user_email)
+        return self.mailboxes[user_email]
+
+    def round_trip(self):
+        """
+        Simulates one HTTP round-trip, raising the injected transport-level errors.
+        """
+        with self._lock:
+            self.http_requests += 1
+            delay = self.latency * self.random.uniform(0.5, 1.5)
+            fail = self.random.random() < self.error_rate
+            status = self.random.choice([429, 503])
+        time.sleep(delay)
+        if fail:
+            return self._error(status)
+
+    def charge(self, user_email: str, method_id: str):
+        """
+        Counts a call of @method_id and returns the error it fails with, if it exceeds the user's quota.
+        """
+        cost = METHOD_COSTS.get(method_id, DEFAULT_COST)
+        now = time.monotonic()
+        with self._lock:
+            self.calls[method_id.rpartition('users.')[2]] += 1
+            self.units += cost
+            if not self.quota_units_per_second:
+                return None
+            usage = self._usage[user_email]
+            while usage and usage[0][0] <= now - 1:
+                usage.pop(0)
+            if sum(units for _, units in usage) + cost > self.quota_units_per_second:
+                self.errors['quota'] += 1
+                return http_error(429, 'rateLimitExceeded')
+            usage.append((now, cost))
+        return None
+
+    def _error(self, status: int):
+        with self._lock:
+            self.errors[status] += 1
+        if status == 429:
+            raise http_error(429, 'rateLimitExceeded')
+        raise http_error(status, 'backendError')
+
+    def stats(self):
+        return {
+            "http_requests": self.http_requests,
+            "calls": dict(self.calls),
+            "units": self.units,
+            "errors": {str(key): value for key, value in self.errors.items()},
+        }
+
+
+class FakeRequest:
+    def __init__(self, mailbox, method_id: str, handler):
+        self.mailbox = mailbox
+        self.methodId = method_id
+        self.handler = handler
+
+    def execute(self):
+        server = self.mailbox.server
+        server.round_trip()
+        error = server.charge(self.mailbox.user_email, self.methodId)
+        if error:
+            raise error
+        return self.run()
+
+    def run(self):
+        with self.mailbox.lock:
+            return self.handler()
+
+
+class FakeBatchRequest:
+    methodId = 'batch'
+
+    def __init__(self, mailbox, callback):
+        self.mailbox = mailbox
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id: str):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        server = self.mailbox.server
+        server.round_trip()
+        for request, request_id in self.requests:
+            error = server.charge(self.mailbox.user_email, request.methodId)
+            if error:
+                self.callback(request_id, None, error)
+                continue
+            try:
+                response = request.run()
+            except googleapiclient.errors.HttpError as request_error:
+                self.callback(request_id, None, request_error)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeMailbox:
+    """
+    One user's Gmail mailbox, exposing the subset of the discovery API the service uses.
+    """
+
+    def __init__(self, server: FakeGmailServer, user_email: str):
+        self.server = server
+        self.user_email = user_email
+        self.lock = threading.Lock()
+        self.history_id = 1000
+        self.changes = []
+        self.store = {}
+        self.label_ids = {name: name for name in ['INBOX', 'TRASH', 'SPAM', 'UNREAD']}
+        self.labeled_at = {}
+
+    # Test helpers
+
+    def add_message(self, sender: str, subject: str, snippet: str, list_unsubscribe: str = None):
+        """
+        Delivers a new INBOX message and returns its ID.
+        """
+        with self.lock:
+            self.history_id += 1
+            message_id = f'{self.user_email}-{len(self.store)}'
+            headers = [{'name': 'Subject', 'value': subject}, {'name': 'From', 'value': sender}]
+            if list_unsubscribe:
+                headers.append({'name': 'List-Unsubscribe', 'value': list_unsubscribe})
+            self.store[message_id] = {'id': message_id, 'threadId': message_id, 'labelIds': ['INBOX', 'UNREAD'],
+                                     'snippet': snippet, 'sizeEstimate': 1000, 'payload': {'headers': headers},
+                                     # One second apart, so "before:" searches can tell messages apart
+                                     'internalDate': str((1600000000 + self.history_id) * 1000)}
+            self.changes.append((self.history_id, message_id))
+            return message_id
+
+    # Discovery resource chain: service.users().messages().get(...)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self)
+
+    def labels(self):
+        return _Labels(self)
+
+    def history(self):
+        return _History(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+    def getProfile(self, userId):
+        return FakeRequest(self, 'gmail.users.getProfile',
+                           lambda: {'emailAddress': self.user_email, 'historyId': str(self.history_id)})
+
+    def watch(self, userId, body):
+        return FakeRequest(self, 'gmail.users.watch', lambda: {'historyId': str(self.history_id)})
+
+    def stop(self, userId):
+        return FakeRequest(self, 'gmail.users.stop', lambda: {})
+
+    def _apply_labels(self, message_id: str, add_label_ids: list, remove_label_ids: list):
+        message = self.store.get(message_id)
+        if message is None:
+            raise http_error(404, 'notFound')
+        for label_id in add_label_ids:
+            if label_id not in self.label_ids.values():
+                raise http_error(400, 'invalidArgument')
+        message['labelIds'] = [label_id for label_id in dict.fromkeys(message['labelIds'] + add_label_ids)
+                               if label_id not in remove_label_ids]
+        if any(label_id.startswith('Label_') for label_id in add_label_ids):
+            self.labeled_at.setdefault(message_id, time.monotonic())
+        return message
+
+
+class _Messages:
+    def __init__(self, mailbox: FakeMailbox):
+        self.mailbox = mailbox
+
+    def list(self, userId, q=None, labelIds=None, maxResults=100, pageToken=None):
+        def handler():
+            matches = [message['id'] for message in reversed(self.mailbox.store.values())
+                       if _matches(message, q, labelIds)]
+            return _page('messages', [{'id': message_id} for message_id in matches], maxResults, pageToken)
+        return FakeRequest(self.mailbox, 'gmail.users.messages.list', handler)
+
+    def get(self, userId, id, format=None, metadataHeaders=None, fields=None):
+        def handler():
+            message = self.mailbox.store.get(id)
+            if message is None:
+                raise http_error(404, 'notFound')
+            return json.loads(json.dumps(message))
+        return FakeRequest(self.mailbox, 'gmail.users.messages.get', handler)
+
+    def modify(self, userId, id, body):
+        return FakeRequest(self.mailbox, 'gmail.users.messages.modify',
+                           lambda: dict(self.mailbox._apply_labels(id, body.get('addLabelIds', []),
+                                                                   body.get('removeLabelIds', []))))
+
+    def batchModify(self, userId, body):
+        def handler():
+            for message_id in body['ids']:
+                if message_id in self.mailbox.store:
+                    self.mailbox._apply_labels(message_id, body.get('addLabelIds', []),
+                                               body.get('removeLabelIds', []))
+            return ''
+        return FakeRequest(self.mailbox, 'gmail.users.messages.batchModify', handler)
+
+    def batchDelete(self, userId, body):
+        def handler():
+            for message_id in body['ids']:
+                self.mailbox.store.pop(message_id, None)
+            return ''
+        return FakeRequest(self.mailbox, 'gmail.users.messages.batchDelete', handler)
+
+
+class _Labels:
+    def __init__(self, mailbox: FakeMailbox):
+        self.mailbox = mailbox
+
+    def list(self, userId):
+        return FakeRequest(self.mailbox, 'gmail.users.labels.list',
+                           lambda: {'labels': [{'name': name, 'id': label_id}
+                                               for name, label_id in self.mailbox.label_ids.items()]})
+
+    def create(self, userId, body):
+        def handler():
+            if body['name'] in self.mailbox.label_ids:
+                raise http_error(409, 'duplicate')
+            label_id = f"Label_{len(self.mailbox.label_ids)}"
+            self.mailbox.label_ids[body['name']] = label_id
+            return {'name': body['name'], 'id': label_id}
+        return FakeRequest(self.mailbox, 'gmail.users.labels.create', handler)
+
+
+class _History:
+    def __init__(self, mailbox: FakeMailbox):
+        self.mailbox = mailbox
+
+    def list(self, userId, startHistoryId, historyTypes=None, labelId=None, maxResults=100, pageToken=None):
+        def handler():
+            changes = [{'id': str(history_id), 'messagesAdded': [{'message': {'id': message_id}}]}
+                       for history_id, message_id in self.mailbox.changes if history_id > int(startHistoryId)]
+            return {**_page('history', changes, maxResults, pageToken), 'historyId': str(self.mailbox.history_id)}
+        return FakeRequest(self.mailbox, 'gmail.users.history.list', handler)
+
+
+def _matches(message: dict, query: str, label_ids: list):
+    if label_ids and not set(label_ids) <= set(message['labelIds']):
+        return False
+    # "from:a" or an OR'd group "from:(a OR b)", optionally with "before:<epoch seconds>"
+    sender_match = re.search(r'from:(\([^)]*\)|\S+)', query or '')
+    if sender_match:
+        sender = next(header['value'] for header in message['payload']['headers'] if header['name'] == 'From')
+        terms = sender_match.group(1).strip('()').lower().split(' or ')
+        if not any(term in sender.lower() for term in terms):
+            return False
+    before_match = re.search(r'before:(\d+)', query or '')
+    if before_match and int(message['internalDate']) >= int(before_match.group(1)) * 1000:
+        return False
+    return True
+
+
+def _page(key: str, items: list, page_size: int, page_token: str):
+    start = int(page_token or 0)
+    page = {key: items[start:start + page_size]} if items[start:start + page_size] else {}
+    if start + page_size < len(items):
+        page['nextPageToken'] = str(start + page_size)
+    return page
+
+
+class FakeOpenAI:
+    """
+    Stand-in for the chat completions API, served through an httpx transport.
+    Answers batched prompts with a JSON array and single prompts with a label, after @latency seconds.
+    Fails with 429/500 with probability @error_rate. Tokens are estimated at 4 characters per token.
+    """
+
+    def __init__(self, latency: float = 0.5, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request):
+        self.requests += 1
+        await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return httpx.Response(self.random.choice([429, 500]), json={'error': {'message': 'injected'}})
+
+        prompt = json.loads(request.content)['messages'][0]['content']
+        answer = self.answer(prompt)
+        prompt_tokens, completion_tokens = math.ceil(len(prompt) / 4), math.ceil(len(answer) / 4)
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        return httpx.Response(200, json={
+            'choices': [{'message': {'role': 'assistant', 'content': answer}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens},
+        })
+
+    def answer(self, prompt: str):
+        yes_no = 'Label:' in prompt
+        lines = [line.strip() for line in prompt.splitlines()]
+        if not any(line.startswith('{"id"') for line in lines):
+            return 'YES' if yes_no else self._label(prompt, prompt)
+        answers = []
+        for line in lines:
+            if line.startswith('{"id"'):
+                email = json.loads(line)
+                label = 'YES' if yes_no else self._label(prompt, email['subject'] + ' ' + email['content'])
+                answers.append({'id': email['id'], 'label': label})
+        return json.dumps(answers)
+
+    @staticmethod
+    def _label(prompt: str, text: str):
+        # Pick a plausible label from the prompt's label list, keyed on the email's wording
+        labels_line = next((line for line in prompt.splitlines() if line.strip().startswith('Labels:')), '')
+        labels = [label.strip(" '\"") for label in labels_line.split(':', 1)[-1].strip(' []').split(',') if label]
+        for keyword, label in (('order', 'Deliveries'), ('invoice', 'Finance'), ('meetup', 'Events/Invitations')):
+            if keyword in text.lower() and label in labels:
+                return label
+        return 'Other' if 'Other' in labels else (labels[0] if labels else 'Other')
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
@@ -0,0 +1,284 @@
+"""
+Offline end-to-end benchmarks. Runs the FastAPI app of routes.py in-process against fake Gmail and
+OpenAI backends and an in-memory Mongo, and prints one JSON report of all scenarios.
+
+    python -m benchmarks.run --users 20 --messages 50 --output results.json
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+SCENARIOS = ['webhook_burst', 'bulk_delete', 'past_email_sort']
+USER_LABELS = ['Other', 'Finance', 'Deliveries', 'Events/Invitations', 'Newsletters/Subscriptions']
+TEMPLATES = [
+    ('Shop <orders@shop.example>', 'Your order #{n} has shipped', 'Track your order {n} on its way'),
+    ('Bank <no-reply@bank.example>', 'Invoice {n} is ready', 'Your monthly invoice of ${n}.00'),
+    ('Meetups <events@meetup.example>', 'Python meetup #{n}', 'Join us on the {n}th for talks'),
+    ('Friend <friend{n}@mail.example>', 'Lunch on day {n}?', 'Are you free for lunch around noon'),
+    ('Digest <digest@news.example>', 'Weekly digest {n}', 'Top stories of week {n}'),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=50, help='messages per user and scenario')
+    parser.add_argument('--notifications', type=int, default=10, help='webhook deliveries per user')
+    parser.add_argument('--duplicate-rate', type=float, default=0.1, help='share of redelivered webhooks')
+    parser.add_argument('--gmail-latency', type=float, default=0.02)
+    parser.add_argument('--gmail-error-rate', type=float, default=0.0)
+    parser.add_argument('--gmail-quota', type=float, default=250, help='units per user per second, 0 disables')
+    parser.add_argument('--openai-latency', type=float, default=0.3)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--mongodb-uri', default='mongomock://', help='defaults to an in-memory database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for queued webhooks')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    return parser.parse_args()
+
+
+def percentiles(samples: list):
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 2)
+
+    return {"p50_ms": at(0.50), "p95_ms": at(0.95), "p99_ms": at(0.99), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    def __init__(self, args, client, gmail, openai):
+        self.args = args
+        self.client = client
+        self.gmail = gmail
+        self.openai = openai
+        self.random = random.Random(args.seed)
+        self.run_id = 0
+
+    async def setup_users(self, scenario: str):
+        """
+        Signs up --users fresh users with the default labels and returns their emails.
+        """
+        from database import db_users, db_accounts
+
+        self.run_id += 1
+        emails = [f'user{index}-{scenario}@bench.example' for index in range(self.args.users)]
+        for email in emails:
+            user_id = (await db_users.insert_one({"email": email, "labels": USER_LABELS,
+                                                  "startLabel": "False"})).inserted_id
+            await db_accounts.insert_one({"userId": user_id, "access_token": "token", "refresh_token": "refresh",
+                                          "expires_at": int(time.time()) + 24 * 3600})
+            # Labels were created in Gmail when the user picked them
+            mailbox = self.gmail.mailbox(email)
+            for label in USER_LABELS:
+                mailbox.label_ids[label] = f'Label_{len(mailbox.label_ids)}'
+        return emails
+
+    def deliver(self, email: str, count: int, template: int = None):
+        mailbox = self.gmail.mailbox(email)
+        message_ids = []
+        for _ in range(count):
+            sender, subject, snippet = TEMPLATES[self.random.randrange(len(TEMPLATES)) if template is None
+                                                 else template]
+            number = self.random.randrange(1000)
+            unsubscribe = '<mailto:unsubscribe@news.example>' if 'digest' in sender else None
+            message_ids.append(mailbox.add_message(sender.format(n=number), subject.format(n=number),
+                                                   snippet.format(n=number), unsubscribe))
+        return message_ids
+
+    async def timed(self, latencies: list, method: str, url: str, **kwargs):
+        started_at = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        latencies.append(time.perf_counter() - started_at)
+        return response
+
+    async def run_job(self, latencies: list, url: str, email: str, body: dict):
+        """
+        Submits a job and follows its progress events until it is finished.
+        Returns the status code of the submission and the finished job, and records the time to finish.
+        """
+        started_at = time.perf_counter()
+        response = await self.client.post(url, json=body)
+        job = response.json() if response.is_success else None
+        if job:
+            async with self.client.stream('GET', f"/jobs/{job['job_id']}/events", params={'email': email}) as events:
+                async for line in events.aiter_lines():
+                    if line.startswith('data: '):
+                        job = json.loads(line[len('data: '):])
+        latencies.append(time.perf_counter() - started_at)
+        return response.status_code, job
+
+    async def webhook_burst(self):
+        """
+        Users receive their messages in --notifications bursts, each announced by a Pub/Sub push
+        (some redelivered). Latency is measured for the webhook acknowledgement and from delivery
+        to the message being labeled.
+        """
+        import routes
+
+        emails = await self.setup_users('webhook')
+        for email in emails:
+            await self.client.post('/gmail_watch', json={'email': email, 'action': 'start'})
+        self.reset_counters()
+
+        ack_latencies, statuses, delivered_at = [], [], {}
+        per_notification = max(1, self.args.messages // self.args.notifications)
+
+        async def push(email: str):
+            for index in range(self.args.notifications):
+                for message_id in self.deliver(email, per_notification):
+                    delivered_at[(email, message_id)] = time.monotonic()
+                data = {'emailAddress': email, 'historyId': self.gmail.mailbox(email).history_id}
+                message = {'data': base64.b64encode(json.dumps(data).encode()).decode(),
+                           'messageId': f'{self.run_id}-{email}-{index}'}
+                deliveries = 2 if self.random.random() < self.args.duplicate_rate else 1
+                for _ in range(deliveries):
+                    response = await self.timed(ack_latencies, 'POST', '/webhook', json={'message': message})
+                    statuses.append(response.status_code)
+                await asyncio.sleep(0)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(push(email) for email in emails))
+        deadline = time.monotonic() + self.args.timeout
+        while routes.webhook_queue.stats()['depth'] and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        duration = time.perf_counter() - started_at
+
+        labeling_latencies = [self.gmail.mailbox(email).labeled_at[message_id] - delivered
+                              for (email, message_id), delivered in delivered_at.items()
+                              if message_id in self.gmail.mailbox(email).labeled_at]
+        return self.report(duration, statuses, ack_latencies, messages=len(delivered_at),
+                           processed=len(labeling_latencies),
+                           labeling_latency=percentiles(labeling_latencies),
+                           queue=routes.webhook_queue.stats())
+
+    async def bulk_delete(self):
+        """
+        Every user bulk-removes one sender with --messages messages among other mail,
+        timed from the request to the end of the background job.
+        """
+        emails = await self.setup_users('delete')
+        for email in emails:
+            self.deliver(email, self.args.messages, template=0)
+            self.deliver(email, self.args.messages // 2, template=3)
+        self.reset_counters()
+
+        latencies, statuses, removed = [], [], 0
+
+        async def remove(email: str):
+            nonlocal removed
+            status, job = await self.run_job(latencies, '/bulk_remove_mails', email,
+                                             {'user_email': email, 'sender_email': 'orders@shop.example'})
+            statuses.append(status if job and job['status'] == 'completed' else 500)
+            removed += job['result']['removed'] if job and job.get('result') else 0
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(remove(email) for email in emails))
+        return self.report(time.perf_counter() - started_at, statuses, latencies,
+                           messages=len(emails) * self.args.messages, processed=removed)
+
+    async def past_email_sort(self):
+        """
+        Every user sorts the last --messages messages of one sender into a sub-label,
+        timed from the request to the end of the background job.
+        """
+        emails = await self.setup_users('sort')
+        for email in emails:
+            self.deliver(email, self.args.messages, template=0)
+        self.reset_counters()
+
+        latencies, statuses, classified = [], [], 0
+
+        async def sort(email: str):
+            nonlocal classified
+            status, job = await self.run_job(latencies, '/past_email_sorter', email,
+                                             {'user_email': email, 'sender_email': 'orders@shop.example',
+                                              'chosen_labels': [False, True, False, False],
+                                              'messages_amount': str(self.args.messages)})
+            statuses.append(status if job and job['status'] == 'completed' else 500)
+            classified += job['result']['fetched'] if job and job.get('result') else 0
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(sort(email) for email in emails))
+        return self.report(time.perf_counter() - started_at, statuses, latencies,
+                           messages=len(emails) * self.args.messages, processed=classified)
+
+    def reset_counters(self):
+        self.gmail.reset_counters()
+        self.openai.reset_counters()
+
+    def report(self, duration: float, statuses: list, latencies: list, messages: int, processed: int, **extra):
+        return {
+            "requests": len(statuses),
+            "failed_requests": sum(1 for status in statuses if status >= 400),
+            "messages": messages,
+            "processed_messages": processed,
+            "duration_seconds": round(duration, 3),
+            "requests_per_second": round(len(statuses) / duration, 2) if duration else None,
+            "messages_per_second": round(processed / duration, 2) if duration else None,
+            "latency": percentiles(latencies),
+            **extra,
+            "gmail": self.gmail.stats(),
+            "openai": self.openai.stats(),
+        }
+
+
+async def main(args):
+    import httpx
+
+    from benchmarks.fakes import FakeGmailServer, FakeOpenAI
+    import email_services
+    import openai_integration
+    import routes
+
+    gmail = FakeGmailServer(args.gmail_latency, args.gmail_error_rate, args.gmail_quota, args.seed)
+    openai = FakeOpenAI(args.openai_latency, args.openai_error_rate, args.seed)
+    email_services.get_gmail_service = lambda user_email, credentials: gmail.mailbox(user_email)
+    openai_integration.openai_client._client = httpx.AsyncClient(base_url=openai_integration.openai_client.base_url,
+                                                                 transport=openai.transport())
+
+    results = {}
+    async with routes.lifespan(routes.app):
+        transport = httpx.ASGITransport(app=routes.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+            benchmark = Benchmark(args, client, gmail, openai)
+            for scenario in args.scenarios:
+                results[scenario] = await getattr(benchmark, scenario)()
+
+    return {
+        "commit": git_commit(),
+        "parameters": {key: value for key, value in vars(args).items() if key != 'output'},
+        "scenarios": results,
+    }
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    # The database client is created on import, so the URI has to be set first
+    os.environ['MONGODB_URI'] = arguments.mongodb_uri
+    # Keep the service's own prints out of the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = json.dumps(asyncio.run(main(arguments)), indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print(report)
@@ -0,0 +1,81 @@
+"""
+Cold start benchmark. Starts fresh interpreters that import the app, run its startup and build
+the first Gmail service, and prints the timings as JSON. Exits with 1 when the median time to a
+ready app exceeds --budget seconds.
+
+    python -m benchmarks.startup --runs 5 --budget 2
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Runs in the child interpreter, with the repository root as working directory
+PROBE = '''
+import asyncio, json, time
+started_at = time.perf_counter()
+import routes
+imported_at = time.perf_counter()
+
+async def main():
+    import google.oauth2.credentials
+    from gmail_service_pool import build_gmail_service
+
+    async with routes.lifespan(routes.app):
+        ready_at = time.perf_counter()
+        credentials = google.oauth2.credentials.Credentials(token="token")
+        build_gmail_service(credentials)
+        first_build_at = time.perf_counter()
+        build_gmail_service(credentials)
+        second_build_at = time.perf_counter()
+    print(json.dumps({
+        "import_seconds": imported_at - started_at,
+        "ready_seconds": ready_at - started_at,
+        "first_service_build_seconds": first_build_at - ready_at,
+        "service_build_seconds": second_build_at - first_build_at,
+    }))
+
+asyncio.run(main())
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=None, help='maximum median ready_seconds')
+    parser.add_argument('--mongodb-uri', default='mongomock://', help='defaults to an in-memory database')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    return parser.parse_args()
+
+
+def run_probe(mongodb_uri: str):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=root, capture_output=True, text=True, check=True,
+                            env={**os.environ, 'MONGODB_URI': mongodb_uri})
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(args):
+    runs = [run_probe(args.mongodb_uri) for _ in range(args.runs)]
+    summary = {}
+    for key in runs[0]:
+        samples = [run[key] for run in runs]
+        summary[key] = {"median": round(statistics.median(samples), 4), "max": round(max(samples), 4)}
+    return {"runs": args.runs, "budget_seconds": args.budget, "timings": summary}
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    report = main(arguments)
+    output = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    if arguments.budget is not None and report["timings"]["ready_seconds"]["median"] > arguments.budget:
+        print(f"Cold start over budget: {report['timings']['ready_seconds']['median']}s > {arguments.budget}s",
+              file=sys.stderr)
+        sys.exit(1)
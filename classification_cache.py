@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+
+from config import CLASSIFICATION_CACHE_SIZE, CLASSIFICATION_CACHE_TTL_SECONDS
+from database import db_classification_cache
+
+_ADDRESS = re.compile(r'<([^>]+)>')
+_VOLATILE = re.compile(r'https?://\S+|\S+@\S+|\b[0-9a-f]{8,}\b')
+_NUMBERS = re.compile(r'\d+')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_text(text: str, limit: int = 200):
+    """
+    Reduces @text to a template: lowercased, with URLs, addresses, IDs and numbers masked.
+    """
+    text = _VOLATILE.sub('*', (text or '').lower())
+    text = _NUMBERS.sub('#', text)
+    return _SPACES.sub(' ', text).strip()[:limit]
+
+
+def normalize_sender(sender: str):
+    match = _ADDRESS.search(sender or '')
+    return (match.group(1) if match else sender or '').strip().lower()
+
+
+def fingerprint(namespace: str, sender: str, subject: str, snippet: str, labels: list):
+    """
+    Returns a cache key for classifying an email in @namespace against @labels.
+    Emails that differ only in numbers, links or IDs share a key.
+    """
+    parts = [namespace, normalize_sender(sender), normalize_text(subject), normalize_text(snippet),
+             '|'.join(sorted(str(label) for label in labels or []))]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ClassificationCache:
+    """
+    Two-tier cache of classification results: an in-process LRU in front of
+    a Mongo collection whose documents expire after @ttl seconds.
+    """
+
+    def __init__(self, collection=db_classification_cache, max_size: int = CLASSIFICATION_CACHE_SIZE,
+                 ttl: int = CLASSIFICATION_CACHE_TTL_SECONDS):
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._indexes_ready = False
+
+    async def get_many(self, keys: list):
+        """
+        Returns a dict of the cached labels of @keys.
+        """
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                found[key] = entry[0]
+                self.memory_hits += 1
+
+        remaining = [key for key in dict.fromkeys(keys) if key not in found]
+        if remaining:
+            try:
+                async for document in self.collection.find({"_id": {"$in": remaining}}, {"label": 1}):
+                    found[document["_id"]] = document["label"]
+                    self._remember(document["_id"], document["label"])
+                    self.db_hits += 1
+            except Exception as error:
+                logging.error(f"Classification cache lookup failed: {error}")
+            self.misses += sum(1 for key in remaining if key not in found)
+        return found
+
+    async def set_many(self, labels: dict):
+        """
+        Stores a dict of key to label in both tiers.
+        """
+        if not labels:
+            return
+        for key, label in labels.items():
+            self._remember(key, label)
+
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            await self._ensure_indexes()
+            await asyncio.gather(*(
+                self.collection.update_one({"_id": key}, {"$set": {"label": label, "createdAt": created_at}},
+                                           upsert=True)
+                for key, label in labels.items()
+            ))
+        except Exception as error:
+            logging.error(f"Classification cache store failed: {error}")
+
+    def stats(self):
+        hits = self.memory_hits + self.db_hits
+        lookups = hits + self.misses
+        return {
+            "size": len(self._entries),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def _remember(self, key: str, label: str):
+        self._entries[key] = (label, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _ensure_indexes(self):
+        if not self._indexes_ready:
+            await self.collection.create_index("createdAt", expireAfterSeconds=self.ttl)
+            self._indexes_ready = True
+
+
+classification_cache = ClassificationCache()
+
+
+async def classify_cached(namespace: str, labels: list, emails: list, classify, answers: list = None):
+    """
+    Classifies (sender, subject, snippet) @emails, sending only cache misses to @classify.
+    @classify receives a list of (subject, snippet) pairs and returns their labels in order.
+    Only answers in @answers (@labels by default) are cached.
+    """
+    answers = labels if answers is None else answers
+    keys = [fingerprint(namespace, sender, subject, snippet, labels) for sender, subject, snippet in emails]
+    cached = await classification_cache.get_many(keys)
+
+    # Classify each uncached fingerprint once, even if several emails share it
+    missing = {}
+    for index, key in enumerate(keys):
+        if key not in cached and key not in missing:
+            missing[key] = index
+    if missing:
+        fresh_labels = await classify([emails[index][1:] for index in missing.values()])
+        fresh = dict(zip(missing, fresh_labels))
+        await classification_cache.set_many({key: label for key, label in fresh.items() if label in answers})
+        cached = {**cached, **fresh}
+
+    logging.info(f"Classification cache: {len(missing)} of {len(keys)} emails sent to classification "
+                 f"(overall hit rate {classification_cache.stats()['hit_rate']:.1%})")
+    return [cached.get(key) for key in keys]
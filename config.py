@@ -8,8 +8,21 @@ CORS_ORIGINS = [
     'http://localhost:8000',
 ]
 
+# Uvicorn server (see main.py). Reload mode only applies to a single worker
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 1))
+SERVER_RELOAD = os.getenv("SERVER_RELOAD", "True") == "True"
+
 OPENAI_KEY = os.getenv("OPENAI_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 MONGODB_URI = os.getenv("MONGODB_URI")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", 5000))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", 10000))
 TOKEN_URI = os.getenv("TOKEN_URI")
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
@@ -29,6 +42,122 @@ CLIENT_SECRETS_FILE = "client_secret.json"
 API_SERVICE_NAME = 'gmail'
 API_VERSION = 'v1'
 
+# Built Gmail service objects are pooled per user (see gmail_service_pool.py)
+GMAIL_SERVICE_POOL_SIZE = int(os.getenv("GMAIL_SERVICE_POOL_SIZE", 256))
+GMAIL_SERVICE_TTL_SECONDS = int(os.getenv("GMAIL_SERVICE_TTL_SECONDS", 1800))
+GMAIL_HTTP_TIMEOUT_SECONDS = int(os.getenv("GMAIL_HTTP_TIMEOUT_SECONDS", 60))
+# Requests per Gmail batch HTTP call (Gmail allows 100, but throttles large batches)
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", 50))
+# Gmail caps messages().list pages at 500 IDs and batchDelete/batchModify at 1000 IDs
+GMAIL_LIST_PAGE_SIZE = 500
+GMAIL_BATCH_MODIFY_SIZE = 1000
+# Senders OR'd into one messages().list search, keeping queries well under Gmail's length limit
+GMAIL_QUERY_MAX_SENDERS = int(os.getenv("GMAIL_QUERY_MAX_SENDERS", 20))
+
+# Gmail quota scheduling (see gmail_scheduler.py). Gmail allows 250 quota units per user per second
+# and 1,200,000 per project per minute. The budgets below apply to each worker process: with
+# SERVER_WORKERS > 1, set the project budget to its share per worker. User syncs stick to one
+# worker, but a user's background jobs may run on another one alongside them.
+GMAIL_USER_UNITS_PER_SECOND = float(os.getenv("GMAIL_USER_UNITS_PER_SECOND", 250))
+GMAIL_PROJECT_UNITS_PER_SECOND = float(os.getenv("GMAIL_PROJECT_UNITS_PER_SECOND", 20000))
+# Share of each bucket that bulk jobs leave free for interactive/webhook work
+GMAIL_BULK_RESERVE_FRACTION = float(os.getenv("GMAIL_BULK_RESERVE_FRACTION", 0.2))
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", 5))
+GMAIL_BACKOFF_BASE_SECONDS = float(os.getenv("GMAIL_BACKOFF_BASE_SECONDS", 1))
+GMAIL_BACKOFF_MAX_SECONDS = float(os.getenv("GMAIL_BACKOFF_MAX_SECONDS", 32))
+
+# Shared OpenAI HTTP client (see openai_integration.py)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 32))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", 30))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 3))
+OPENAI_BACKOFF_BASE_SECONDS = float(os.getenv("OPENAI_BACKOFF_BASE_SECONDS", 0.5))
+OPENAI_BACKOFF_MAX_SECONDS = float(os.getenv("OPENAI_BACKOFF_MAX_SECONDS", 20))
+# Emails classified per batched completion
+OPENAI_CLASSIFY_BATCH_SIZE = int(os.getenv("OPENAI_CLASSIFY_BATCH_SIZE", 20))
+
+# GPT classification results are cached by content fingerprint (see classification_cache.py)
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", 10000))
+CLASSIFICATION_CACHE_TTL_SECONDS = int(os.getenv("CLASSIFICATION_CACHE_TTL_SECONDS", 30 * 24 * 3600))
+
+# Sender -> label rules are learned after this many identical GPT decisions (see rules.py)
+RULE_LEARN_THRESHOLD = int(os.getenv("RULE_LEARN_THRESHOLD", 3))
+RULE_CACHE_SIZE = int(os.getenv("RULE_CACHE_SIZE", 1024))
+
+# Per-user naive Bayes models trained on GPT labels (see local_classifier.py)
+LOCAL_CLASSIFIER_FEATURES = int(os.getenv("LOCAL_CLASSIFIER_FEATURES", 4096))
+# Predictions below this probability, or from models trained on fewer emails, go to GPT
+LOCAL_CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("LOCAL_CLASSIFIER_MIN_CONFIDENCE", 0.95))
+LOCAL_CLASSIFIER_MIN_SAMPLES = int(os.getenv("LOCAL_CLASSIFIER_MIN_SAMPLES", 50))
+# A label is predicted locally only once the model has seen this many emails of it
+LOCAL_CLASSIFIER_MIN_CLASS_SAMPLES = int(os.getenv("LOCAL_CLASSIFIER_MIN_CLASS_SAMPLES", 10))
+# Share of confident predictions still sent to GPT to measure the models' accuracy
+LOCAL_CLASSIFIER_AUDIT_RATE = float(os.getenv("LOCAL_CLASSIFIER_AUDIT_RATE", 0.05))
+LOCAL_CLASSIFIER_CACHE_SIZE = int(os.getenv("LOCAL_CLASSIFIER_CACHE_SIZE", 256))
+LOCAL_CLASSIFIER_SAVE_INTERVAL_SECONDS = int(os.getenv("LOCAL_CLASSIFIER_SAVE_INTERVAL_SECONDS", 60))
+
+# Per-user sender statistics, backfilled from the most recent messages (see sender_index.py)
+SENDER_INDEX_BACKFILL_LIMIT = int(os.getenv("SENDER_INDEX_BACKFILL_LIMIT", 10000))
+SENDER_INDEX_BACKFILL_PAGE_SIZE = int(os.getenv("SENDER_INDEX_BACKFILL_PAGE_SIZE", 500))
+# A backfill marked as building for longer than this is assumed dead and restarted
+SENDER_INDEX_STALE_SECONDS = int(os.getenv("SENDER_INDEX_STALE_SECONDS", 3600))
+# A failed backfill is started again by requests only after this long
+SENDER_INDEX_RETRY_SECONDS = int(os.getenv("SENDER_INDEX_RETRY_SECONDS", 600))
+
+# Long mailbox operations run as background jobs with checkpoints in Mongo (see jobs.py)
+JOBS_MAX_RUNNING = int(os.getenv("JOBS_MAX_RUNNING", 8))
+JOBS_MAX_RUNNING_PER_USER = int(os.getenv("JOBS_MAX_RUNNING_PER_USER", 1))
+# Queued and running jobs a user may have before new ones are refused
+JOBS_MAX_ACTIVE_PER_USER = int(os.getenv("JOBS_MAX_ACTIVE_PER_USER", 10))
+JOBS_POLL_SECONDS = float(os.getenv("JOBS_POLL_SECONDS", 1))
+JOBS_HEARTBEAT_SECONDS = float(os.getenv("JOBS_HEARTBEAT_SECONDS", 10))
+# A running job without heartbeat for this long is resumed by another worker
+JOBS_STALE_SECONDS = float(os.getenv("JOBS_STALE_SECONDS", 60))
+JOBS_RETENTION_SECONDS = int(os.getenv("JOBS_RETENTION_SECONDS", 7 * 24 * 3600))
+# Messages classified and labeled between two checkpoints of the past email sorter
+JOBS_CHUNK_SIZE = int(os.getenv("JOBS_CHUNK_SIZE", 200))
+# Wait before bulk removal searches again when the search still shows removed messages
+JOBS_RELIST_DELAY_SECONDS = float(os.getenv("JOBS_RELIST_DELAY_SECONDS", 2))
+# Largest messages_amount the past email sorter accepts, per sender
+JOBS_MAX_MESSAGES_PER_SENDER = int(os.getenv("JOBS_MAX_MESSAGES_PER_SENDER", 5000))
+
+# Webhook notifications are processed by a background worker pool (see webhook_queue.py)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_MAX_PENDING = int(os.getenv("WEBHOOK_QUEUE_MAX_PENDING", 10000))
+WEBHOOK_DRAIN_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SECONDS", 25))
+# Notifications of a user arriving within this window are merged into one sync
+WEBHOOK_COALESCE_WINDOW_SECONDS = float(os.getenv("WEBHOOK_COALESCE_WINDOW_SECONDS", 2))
+# Most recent INBOX messages re-checked when Gmail no longer has the stored history ID
+HISTORY_RESYNC_LIMIT = int(os.getenv("HISTORY_RESYNC_LIMIT", 100))
+# Syncs that may fail to fetch a message before it is skipped and the history ID moves past it
+SYNC_MESSAGE_MAX_ATTEMPTS = int(os.getenv("SYNC_MESSAGE_MAX_ATTEMPTS", 5))
+
+# Pub/Sub and Gmail message IDs already handled are remembered for deduplication (see dedup.py)
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", 24 * 3600))
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", 100000))
+# Defaults to on with several workers, which receive each other's redeliveries
+DEDUP_SHARED = os.getenv("DEDUP_SHARED", str(SERVER_WORKERS > 1)) == "True"
+
+# Worker processes coordinate user syncs through Mongo (see coordination.py)
+SYNC_LEASE_TTL_SECONDS = float(os.getenv("SYNC_LEASE_TTL_SECONDS", 30))
+WORKER_HEARTBEAT_SECONDS = float(os.getenv("WORKER_HEARTBEAT_SECONDS", 5))
+# Workers without heartbeat for this long no longer own users
+WORKER_STALE_SECONDS = float(os.getenv("WORKER_STALE_SECONDS", 15))
+SYNC_PENDING_POLL_SECONDS = float(os.getenv("SYNC_PENDING_POLL_SECONDS", 1))
+
+# Adds a Server-Timing header with the per-stage breakdown to every response (see metrics.py)
+METRICS_DEBUG_TIMING = os.getenv("METRICS_DEBUG_TIMING", "False") == "True"
+
+# OAuth credentials are cached per user (see credential_cache.py)
+CREDENTIAL_CACHE_SIZE = int(os.getenv("CREDENTIAL_CACHE_SIZE", 1024))
+# Cached credentials are reloaded this long after they were read, however often they are used
+CREDENTIAL_CACHE_TTL_SECONDS = int(os.getenv("CREDENTIAL_CACHE_TTL_SECONDS", 3600))
+CREDENTIAL_REFRESH_AHEAD_SECONDS = int(os.getenv("CREDENTIAL_REFRESH_AHEAD_SECONDS", 300))
+
+# Gmail label name -> ID lookups are cached per user (see label_index.py)
+LABEL_INDEX_SIZE = int(os.getenv("LABEL_INDEX_SIZE", 1024))
+LABEL_INDEX_MIN_REFRESH_SECONDS = int(os.getenv("LABEL_INDEX_MIN_REFRESH_SECONDS", 30))
+
 SCOPES_LIST = ['https://www.googleapis.com/auth/gmail.readonly',
           'https://www.googleapis.com/auth/gmail.modify',
           'https://www.googleapis.com/auth/gmail.labels',
@@ -85,4 +214,16 @@ label_color_dict = {
                'color': {'textColor': '#ffffff', 'backgroundColor': '#822111'}},
     'Other': {'name': 'Other', 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show',
               'color': {'textColor': '#000000', 'backgroundColor': '#666666'}}
-}
\ No newline at end of file
+}
+
+# Deterministic labeling rules, applied before GPT (see rules.py)
+rule_sender_domains = {
+    'Deliveries': ['ups.com', 'fedex.com', 'dhl.com', 'usps.com', 'royalmail.com', 'canadapost.ca', 'aramex.com',
+                   'shipment-tracking.amazon.com'],
+    'Finance': ['paypal.com', 'chase.com', 'bankofamerica.com', 'wellsfargo.com', 'citi.com', 'americanexpress.com',
+                'capitalone.com', 'revolut.com', 'wise.com', 'coinbase.com'],
+    'Social Media': ['facebookmail.com', 'linkedin.com', 'twitter.com', 'x.com', 'instagram.com', 'tiktok.com',
+                     'redditmail.com', 'pinterest.com', 'discord.com'],
+}
+
+rule_receipt_keywords = ['receipt', 'invoice', 'payment received', 'payment confirmation', 'billing statement']
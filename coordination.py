@@ -0,0 +1,254 @@
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import logging
+import os
+import socket
+
+import pymongo
+import pymongo.errors
+from pymongo import ReturnDocument
+
+from config import SYNC_LEASE_TTL_SECONDS, WORKER_HEARTBEAT_SECONDS, WORKER_STALE_SECONDS, SYNC_PENDING_POLL_SECONDS
+from database import db_leases, db_workers, db_pending_syncs
+
+# Identifies this process in leases, the worker registry and jobs
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def rendezvous_owner(key: str, workers: list):
+    """
+    Returns the worker of @workers with the highest hash for @key (rendezvous hashing):
+    every worker computes the same owner, and only the keys of a worker that joins
+    or leaves move.
+    """
+    return max(workers, key=lambda worker: hashlib.blake2b(f"{worker}|{key}".encode(), digest_size=8).digest())
+
+
+class Lease:
+    def __init__(self, key: str, expires_at: datetime.datetime):
+        self.key = key
+        self.expires_at = expires_at
+        self.lost = False
+
+
+class LeaseManager:
+    """
+    Mongo-backed exclusive leases. A lease is held by one worker until it is released or
+    its @ttl expires; hold() and keep() renew it every third of @ttl while the caller works, and mark
+    it lost if the renewal fails so the caller can avoid committing its results.
+    """
+
+    def __init__(self, collection=db_leases, worker_id: str = WORKER_ID, ttl: float = SYNC_LEASE_TTL_SECONDS):
+        self.collection = collection
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.acquired = 0
+        self.contended = 0
+        self.lost = 0
+
+    async def acquire(self, key: str):
+        """
+        Returns a Lease on @key, or None if another worker holds an unexpired one.
+        """
+        now = _now()
+        expires_at = now + datetime.timedelta(seconds=self.ttl)
+        try:
+            # Matches a free (expired) lease or our own; otherwise the upsert collides on _id
+            await self.collection.find_one_and_update(
+                {"_id": key, "$or": [{"expiresAt": {"$lt": now}}, {"owner": self.worker_id}]},
+                {"$set": {"owner": self.worker_id, "expiresAt": expires_at}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            self.contended += 1
+            return None
+        self.acquired += 1
+        return Lease(key, expires_at)
+
+    async def renew(self, lease: Lease):
+        expires_at = _now() + datetime.timedelta(seconds=self.ttl)
+        result = await self.collection.update_one({"_id": lease.key, "owner": self.worker_id},
+                                                  {"$set": {"expiresAt": expires_at}})
+        if not result.matched_count:
+            return False
+        lease.expires_at = expires_at
+        return True
+
+    async def release(self, lease: Lease):
+        try:
+            await self.collection.delete_one({"_id": lease.key, "owner": self.worker_id})
+        except pymongo.errors.PyMongoError as error:
+            # It expires on its own
+            logging.error(f"Failed to release lease {lease.key}: {error}")
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str):
+        """
+        Holds the lease on @key for the enclosed block, yielding the Lease, or None if it is taken.
+        """
+        lease = await self.acquire(key)
+        if lease is None:
+            yield None
+            return
+        async with self.keep(lease):
+            yield lease
+
+    @contextlib.asynccontextmanager
+    async def keep(self, lease: Lease):
+        """
+        Renews an acquired @lease for the enclosed block, then releases it.
+        """
+        key = lease.key
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(self.ttl / 3)
+                try:
+                    renewed = await self.renew(lease)
+                except pymongo.errors.PyMongoError as error:
+                    logging.error(f"Failed to renew lease {key}: {error}")
+                    renewed = lease.expires_at > _now()
+                if not renewed:
+                    lease.lost = True
+                    self.lost += 1
+                    return
+
+        task = asyncio.create_task(heartbeat())
+        try:
+            yield lease
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            if not lease.lost:
+                await self.release(lease)
+
+    def stats(self):
+        return {"acquired": self.acquired, "contended": self.contended, "lost": self.lost}
+
+
+class SyncCoordinator:
+    """
+    Spreads user syncs over the worker processes. Workers register in Mongo with a heartbeat,
+    and each user is owned by one live worker chosen by rendezvous hashing, so a user's caches
+    (credentials, labels, models) stay warm in one process. Notifications received by another
+    worker are left as a pending flag (with the lowest history ID) that the owner picks up
+    every @poll_interval seconds. The per-user sync lease keeps syncs exclusive while
+    ownership moves between workers.
+    """
+
+    def __init__(self, workers=db_workers, pending=db_pending_syncs, worker_id: str = WORKER_ID,
+                 heartbeat_interval: float = WORKER_HEARTBEAT_SECONDS, stale_after: float = WORKER_STALE_SECONDS,
+                 poll_interval: float = SYNC_PENDING_POLL_SECONDS):
+        self.workers = workers
+        self.pending = pending
+        self.worker_id = worker_id
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.enqueue = None
+        self.local = 0
+        self.forwarded = 0
+        self.picked_up = 0
+        self._live_workers = [worker_id]
+        self._tasks = []
+
+    async def start(self, enqueue):
+        """
+        Registers this worker and starts picking up its pending users,
+        handing them to @enqueue(user_email, notification).
+        """
+        self.enqueue = enqueue
+        await self._heartbeat_once()
+        self._tasks = [asyncio.create_task(self._heartbeat()), asyncio.create_task(self._poll())]
+
+    async def stop(self):
+        """
+        Stops picking up users and unregisters, so the other workers take them over right away.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.workers.delete_one({"_id": self.worker_id})
+        except pymongo.errors.PyMongoError as error:
+            logging.error(f"Failed to unregister worker {self.worker_id}: {error}")
+
+    def owner(self, user_email: str):
+        return rendezvous_owner(user_email, self._live_workers)
+
+    async def dispatch(self, user_email: str, notification: dict):
+        """
+        Queues @notification here if this worker owns @user_email, else flags the user as pending for its owner.
+        Raises QueueFullError when the local queue is full.
+        """
+        if self.owner(user_email) == self.worker_id:
+            self.enqueue(user_email, notification)
+            self.local += 1
+        else:
+            await self.defer(user_email, int(notification["historyId"]))
+            self.forwarded += 1
+
+    async def defer(self, user_email: str, history_id: int):
+        """
+        Flags @user_email as pending from @history_id, for its owner to sync.
+        """
+        await self.pending.update_one({"_id": user_email},
+                                      {"$min": {"historyId": history_id}, "$setOnInsert": {"since": _now()}},
+                                      upsert=True)
+
+    def stats(self):
+        return {
+            "workers": len(self._live_workers),
+            "local": self.local,
+            "forwarded": self.forwarded,
+            "picked_up": self.picked_up,
+        }
+
+    async def _heartbeat_once(self):
+        now = _now()
+        await self.workers.update_one({"_id": self.worker_id}, {"$set": {"heartbeatAt": now}}, upsert=True)
+        live_since = now - datetime.timedelta(seconds=self.stale_after)
+        workers = await self.workers.find({"heartbeatAt": {"$gte": live_since}}, {"_id": 1}).to_list(length=None)
+        self._live_workers = sorted({worker["_id"] for worker in workers} | {self.worker_id})
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._heartbeat_once()
+            except Exception as error:
+                logging.error(f"Worker heartbeat failed: {error}")
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._pick_up()
+            except Exception as error:
+                logging.error(f"Error picking up pending syncs: {error}")
+
+    async def _pick_up(self):
+        users = await self.pending.find({}, {"_id": 1}).to_list(length=None)
+        for user in users:
+            user_email = user["_id"]
+            if self.owner(user_email) != self.worker_id:
+                continue
+            document = await self.pending.find_one_and_delete({"_id": user_email})
+            if not document:
+                continue
+            try:
+                self.enqueue(user_email, {"emailAddress": user_email, "historyId": document["historyId"]})
+                self.picked_up += 1
+            except Exception as error:
+                logging.warning(f"Could not queue pending sync of {user_email}: {error}")
+                await self.defer(user_email, document["historyId"])
+
+
+sync_leases = LeaseManager()
+sync_coordinator = SyncCoordinator()
@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import logging
+import time
+from collections import OrderedDict
+
+from config import TOKEN_URI, CLIENT_ID, CLIENT_SECRET, SCOPES_LIST, CREDENTIAL_CACHE_SIZE, \
+    CREDENTIAL_CACHE_TTL_SECONDS, CREDENTIAL_REFRESH_AHEAD_SECONDS
+from database import db_accounts
+from user_repository import get_user_with_account
+
+
+class CredentialCache:
+    """
+    Process-local cache of OAuth credentials keyed by user email, reloaded from the
+    accounts collection @ttl seconds after they were loaded.
+    Tokens are refreshed shortly before they expire, with at most one refresh running
+    per user - concurrent callers wait for it instead of refreshing again.
+    Tokens are written back to the accounts collection only when they change.
+    """
+
+    def __init__(self, max_size: int = CREDENTIAL_CACHE_SIZE, ttl: int = CREDENTIAL_CACHE_TTL_SECONDS,
+                 refresh_ahead: int = CREDENTIAL_REFRESH_AHEAD_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.refresh_ahead = datetime.timedelta(seconds=refresh_ahead)
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries = OrderedDict()
+        self._locks = {}
+
+    async def get(self, user_email: str):
+        """
+        Returns valid credentials for @user_email, or None if the user has none.
+        """
+        entry = self._entries.get(user_email)
+        if entry and self._is_fresh(entry):
+            self.hits += 1
+            self._touch(user_email, entry)
+            try:
+                # The transport may have refreshed the token on a 401 response
+                await self._write_back(entry)
+            except Exception as error:
+                logging.error(f"{user_email} {error}")
+                self.invalidate(user_email)
+                return
+            return entry["credentials"]
+
+        lock = self._locks.setdefault(user_email, asyncio.Lock())
+        async with lock:
+            # Another caller may have loaded or refreshed the credentials while we waited
+            entry = self._entries.get(user_email)
+            if entry and self._is_fresh(entry):
+                self.hits += 1
+                self._touch(user_email, entry)
+                return entry["credentials"]
+
+            self.misses += 1
+            try:
+                if not entry or self._is_expired(entry):
+                    entry = await self._load(user_email)
+                    if not entry:
+                        return
+                if self._needs_refresh(entry["credentials"]):
+                    await asyncio.to_thread(_refresh, entry["credentials"])
+                    self.refreshes += 1
+                    await self._write_back(entry)
+            except Exception as error:
+                logging.error(f"{user_email} {error}")
+                self.invalidate(user_email)
+                return
+
+            self._touch(user_email, entry)
+            self._evict()
+            return entry["credentials"]
+
+    def invalidate(self, user_email: str):
+        """
+        Drops cached credentials of @user_email, e.g. after the account was removed.
+        """
+        self._entries.pop(user_email, None)
+        lock = self._locks.get(user_email)
+        if lock and not lock.locked():
+            del self._locks[user_email]
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+        }
+
+    async def _load(self, user_email: str):
+        # Imported on first use to keep worker startup fast (see gmail_service_pool.preload)
+        import google.oauth2.credentials
+
+        user = await get_user_with_account(user_email)
+        if not user or not user.get("account"):
+            return
+        account = user["account"]
+
+        expires_at = account.get("expires_at")
+        credentials = google.oauth2.credentials.Credentials(
+            token=account.get("access_token"),
+            refresh_token=account.get("refresh_token"),
+            token_uri=TOKEN_URI,
+            client_id=CLIENT_ID,
+            client_secret=CLIENT_SECRET,
+            scopes=SCOPES_LIST,
+            expiry=datetime.datetime.utcfromtimestamp(expires_at) if expires_at else None
+        )
+        return {
+            "credentials": credentials,
+            "user_id": user["_id"],
+            "stored_token": credentials.token,
+            "stored_refresh_token": credentials.refresh_token,
+            "loaded_at": time.monotonic(),
+        }
+
+    async def _write_back(self, entry):
+        credentials = entry["credentials"]
+        if credentials.token == entry["stored_token"] and credentials.refresh_token == entry["stored_refresh_token"]:
+            return
+
+        update_data = {"access_token": credentials.token, "refresh_token": credentials.refresh_token}
+        if credentials.expiry:
+            update_data["expires_at"] = int(credentials.expiry.replace(tzinfo=datetime.timezone.utc).timestamp())
+        await db_accounts.update_one({"userId": entry["user_id"]}, {"$set": update_data})
+        entry["stored_token"] = credentials.token
+        entry["stored_refresh_token"] = credentials.refresh_token
+
+    def _needs_refresh(self, credentials):
+        if not credentials.refresh_token:
+            return False
+        if not credentials.token:
+            return True
+        if not credentials.expiry:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - now <= self.refresh_ahead
+
+    def _is_expired(self, entry):
+        return time.monotonic() - entry["loaded_at"] >= self.ttl
+
+    def _is_fresh(self, entry):
+        return not self._is_expired(entry) and not self._needs_refresh(entry["credentials"])
+
+    def _touch(self, user_email: str, entry):
+        self._entries[user_email] = entry
+        self._entries.move_to_end(user_email)
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            user_email, _ = self._entries.popitem(last=False)
+            lock = self._locks.get(user_email)
+            if lock and not lock.locked():
+                del self._locks[user_email]
+
+
+def _refresh(credentials):
+    import google.auth.transport.requests
+
+    credentials.refresh(google.auth.transport.requests.Request())
+
+
+credential_cache = CredentialCache()
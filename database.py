@@ -1,7 +1,38 @@
-import pymongo
-from config import MONGODB_URI
+import motor.motor_asyncio
+from config import MONGODB_URI, MONGODB_MAX_POOL_SIZE, MONGODB_MIN_POOL_SIZE, MONGODB_CONNECT_TIMEOUT_MS, \
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS, MONGODB_SOCKET_TIMEOUT_MS
 
-main_cluster = pymongo.MongoClient(MONGODB_URI, uuidRepresentation="standard")
+
+def create_client(uri: str = MONGODB_URI):
+    """
+    Creates the async Mongo client. A "mongomock://" URI gives an in-memory
+    stand-in (requires mongomock-motor), for tests and benchmarks.
+    """
+    if uri and uri.startswith("mongomock://"):
+        from mongomock_motor import AsyncMongoMockClient
+        return AsyncMongoMockClient()
+
+    return motor.motor_asyncio.AsyncIOMotorClient(
+        uri,
+        uuidRepresentation="standard",
+        maxPoolSize=MONGODB_MAX_POOL_SIZE,
+        minPoolSize=MONGODB_MIN_POOL_SIZE,
+        connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS
+    )
+
+
+main_cluster = create_client()
 database = main_cluster["main"]
 db_accounts = database["accounts"]
 db_users = database["users"]
+db_classification_cache = database["classification_cache"]
+db_sender_labels = database["sender_labels"]
+db_processed_events = database["processed_events"]
+db_classifier_models = database["classifier_models"]
+db_sender_stats = database["sender_stats"]
+db_jobs = database["jobs"]
+db_leases = database["leases"]
+db_workers = database["workers"]
+db_pending_syncs = database["pending_syncs"]
@@ -0,0 +1,147 @@
+import datetime
+import logging
+import time
+from collections import OrderedDict
+
+import pymongo.errors
+from pymongo import ReturnDocument
+
+from config import DEDUP_TTL_SECONDS, DEDUP_MAX_SIZE, DEDUP_SHARED
+from database import db_processed_events
+
+
+class TTLSet:
+    """
+    Set of keys that expire @ttl seconds after being added, holding at most @max_size keys.
+    """
+
+    def __init__(self, ttl: int = DEDUP_TTL_SECONDS, max_size: int = DEDUP_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._keys = OrderedDict()
+
+    def add(self, key: str):
+        """
+        Adds @key, returning False if it was already present.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._keys:
+            return False
+        self._keys[key] = now + self.ttl
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+        return True
+
+    def discard(self, key: str):
+        self._keys.pop(key, None)
+
+    def __contains__(self, key: str):
+        expires_at = self._keys.get(key)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _expire(self, now: float):
+        # Keys are kept in insertion order, so expired ones are at the front
+        while self._keys:
+            key, expires_at = next(iter(self._keys.items()))
+            if expires_at > now:
+                break
+            del self._keys[key]
+
+
+class DedupStore:
+    """
+    Idempotency guard for at-least-once deliveries. A key can be claimed once;
+    later claims within @ttl seconds fail. With @shared, claims also go through a Mongo
+    collection with a TTL index, so duplicates are caught across workers.
+    Failed attempts at processing a key are counted for @ttl seconds as well.
+    """
+
+    def __init__(self, collection=db_processed_events, ttl: int = DEDUP_TTL_SECONDS, max_size: int = DEDUP_MAX_SIZE,
+                 shared: bool = DEDUP_SHARED):
+        self.collection = collection
+        self.ttl = ttl
+        self.shared = shared
+        self.duplicates = 0
+        self._local = TTLSet(ttl, max_size)
+        self._failures = OrderedDict()
+        self._max_size = max_size
+        self._indexes_ready = False
+
+    async def claim(self, key: str):
+        """
+        Returns True if @key was not seen before and is now claimed by the caller.
+        """
+        return bool(await self.claim_many([key]))
+
+    async def claim_many(self, keys: list):
+        """
+        Claims @keys and returns the ones that were not seen before, in order.
+        """
+        claimed = [key for key in dict.fromkeys(keys) if self._local.add(key)]
+        if claimed and self.shared:
+            duplicates = await self._claim_shared(claimed)
+            claimed = [key for key in claimed if key not in duplicates]
+        self.duplicates += len(keys) - len(claimed)
+        return claimed
+
+    async def release(self, keys: list):
+        """
+        Forgets claimed @keys, so a failed delivery can be processed again.
+        """
+        for key in keys:
+            self._local.discard(key)
+        if keys and self.shared:
+            try:
+                await self.collection.delete_many({"_id": {"$in": list(keys)}})
+            except Exception as error:
+                logging.error(f"Failed to release dedup keys: {error}")
+
+    async def count_failure(self, key: str):
+        """
+        Records a failed attempt at processing @key and returns the number of failed attempts so far.
+        """
+        attempts = self._failures.pop(key, 0) + 1
+        self._failures[key] = attempts
+        while len(self._failures) > self._max_size:
+            self._failures.popitem(last=False)
+        if self.shared:
+            try:
+                await self._ensure_indexes()
+                document = await self.collection.find_one_and_update(
+                    {"_id": f"failures:{key}"},
+                    {"$inc": {"attempts": 1},
+                     "$setOnInsert": {"createdAt": datetime.datetime.now(datetime.timezone.utc)}},
+                    upsert=True, return_document=ReturnDocument.AFTER)
+                attempts = document["attempts"]
+            except Exception as error:
+                logging.error(f"Failed to count the attempts of {key}: {error}")
+        return attempts
+
+    def stats(self):
+        return {"size": len(self._local), "duplicates": self.duplicates, "shared": self.shared}
+
+    async def _claim_shared(self, keys: list):
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            await self._ensure_indexes()
+            await self.collection.insert_many([{"_id": key, "createdAt": created_at} for key in keys], ordered=False)
+        except pymongo.errors.BulkWriteError as error:
+            # Keys another worker inserted first fail with a duplicate key error (code 11000)
+            return {keys[write_error["index"]] for write_error in error.details["writeErrors"]
+                    if write_error["code"] == 11000}
+        except Exception as error:
+            # Fall back to the in-process set rather than dropping the delivery
+            logging.error(f"Shared dedup store unavailable: {error}")
+        return set()
+
+    async def _ensure_indexes(self):
+        if not self._indexes_ready:
+            await self.collection.create_index("createdAt", expireAfterSeconds=self.ttl)
+            self._indexes_ready = True
+
+
+dedup_store = DedupStore()
@@ -1,49 +1,35 @@
-import googleapiclient.discovery
-import google.oauth2.credentials
+import googleapiclient.errors
 from fastapi import HTTPException
 
 from config import *
 from database import *
-from openai_integration import gpt_call, gpt_call_filter_by_sender
+from openai_integration import gpt_call_batch, gpt_call_filter_by_sender_batch
+from gmail_service_pool import get_gmail_service
+from credential_cache import credential_cache
+from label_index import label_index
+from classification_cache import classify_cached, normalize_sender
+from rules import rule_engine
+from local_classifier import local_classifier
+from sender_index import sender_index
+from sender_filters import sender_queries, attribute_sender, sender_label_name
+from history_sync import sync_new_messages
+from dedup import dedup_store
+from coordination import sync_leases, sync_coordinator
+from user_repository import get_user
+from gmail_batch import batch_get_metadata, get_header, list_message_page, batch_delete, batch_modify
+from gmail_scheduler import gmail_scheduler, BULK
+from metrics import stage, route_context
+import asyncio
 import logging
-from itertools import chain
+from collections import Counter
 
 async def create_credentials(user_email):
-    user = db_users.find_one({"email": user_email})
-    if user:
-        user_id = user["_id"]
-        account = db_accounts.find_one({"userId": user_id})
-        user_access_token = account.get("access_token")
-        user_refresh_token = account.get("refresh_token")
-
-        # Credentials fetch
-        try:
-            credentials = google.oauth2.credentials.Credentials(
-                token=user_access_token,
-                refresh_token=user_refresh_token,
-                token_uri=TOKEN_URI,
-                client_id=CLIENT_ID,
-                client_secret=CLIENT_SECRET,
-                scopes=SCOPES_LIST
-            )
-            
-            if credentials.expired and credentials.refresh_token:
-                request = google.auth.transport.requests.Request()
-                credentials.refresh(request)
-                # Store the new access token and refresh token in the database
-                db_accounts.update_one(
-                    {"userId": user_id},
-                    {"$set": {
-                        "access_token": credentials.token,
-                        "refresh_token": credentials.refresh_token  
-                    }}
-                )
-
-        except Exception as error:
-            logging.error(f"{user_email} {error}")
-            return
-
-        return credentials
+    """
+    Returns OAuth credentials for @user_email from the credential cache,
+    refreshing the access token when it is about to expire.
+    """
+    with stage('credentials'):
+        return await credential_cache.get(user_email)
 
 async def manage_gmail_watch(user_email: str, start_watch: bool):
     """
@@ -54,30 +40,34 @@ async def manage_gmail_watch(user_email: str, start_watch: bool):
     if not credentials_doc:
         raise HTTPException(status_code=400, detail=f"Credentials not found for user {user_email}")
 
-    service = googleapiclient.discovery.build(API_SERVICE_NAME, API_VERSION, credentials=credentials_doc)
+    service = get_gmail_service(user_email, credentials_doc)
 
     if start_watch:
         request_body = {'labelIds': ['INBOX'], 'topicName': TOPIC_NAME}
-        service.users().watch(userId='me', body=request_body).execute()
+        watch_response = await gmail_scheduler.execute(service.users().watch(userId='me', body=request_body),
+                                                       user_email)
 
-        # Update database to indicate that the watch has started
+        # Update database to indicate that the watch has started,
+        # and sync history from the point the watch started at
         filter_criteria = {"email": user_email}
-        update_data = {"$set": {"startLabel": "True"}}
+        update_data = {"$set": {"startLabel": "True", "historyId": int(watch_response['historyId'])}}
     else:
         # Stop watching for changes
-        service.users().stop(userId='me').execute()
+        await gmail_scheduler.execute(service.users().stop(userId='me'), user_email)
 
         filter_criteria = {"email": user_email}
         update_data = {"$set": {"startLabel": "False"}}
 
-    db_users.update_one(filter_criteria, update_data, upsert=True)
+    await db_users.update_one(filter_criteria, update_data, upsert=True)
 
 
-async def get_email_from_watch(webhook_email: str, webhook_history_id: str):
+async def get_email_from_watch(webhook_email: str, webhook_history_id: int):
     """
     Processes new Gmail messages from a webhook, checks for labels, and applies labels based on the email content
-    using the Gmail API and GPT. Retrieves user credentials, filters message history, and applies appropriate labels
-    to new, unlabeled messages.
+    using the Gmail API and GPT. Retrieves user credentials, reads the INBOX messages added since the stored
+    history ID (or @webhook_history_id if none is stored yet), and applies appropriate labels to new, unlabeled
+    messages. Returns the history ID the next sync should start from, or None if the sync failed or left
+    messages that could not be fetched, which are retried up to @SYNC_MESSAGE_MAX_ATTEMPTS times.
     """
 
     # Retrieve credentials from MongoDB based on the webhook email
@@ -87,7 +77,7 @@ async def get_email_from_watch(webhook_email: str, webhook_history_id: str):
         raise HTTPException(status_code=400, detail=f"Credentials not found for user {webhook_email}")
 
     # Retrieve user info (labels and startLabel flag)
-    user_info = db_users.find_one({"email": webhook_email})
+    user_info = await get_user(webhook_email, ["labels", "startLabel", "historyId"])
     if not user_info:
         logging.error(f"User info not found for {webhook_email}")
         return
@@ -101,60 +91,117 @@ async def get_email_from_watch(webhook_email: str, webhook_history_id: str):
         return
 
     # Use credentials to interact with Gmail API
-    service = googleapiclient.discovery.build('gmail', 'v1', credentials=credentials_doc)
+    service = get_gmail_service(webhook_email, credentials_doc)
 
-    # Fetch history from Gmail API
+    # Fetch the messages added to INBOX since the last sync from Gmail history
+    cursor = int(user_info.get("historyId") or webhook_history_id)
     try:
-        response = service.users().history().list(userId='me', startHistoryId=webhook_history_id).execute()
+        new_message_ids, latest_history_id = await sync_new_messages(service, webhook_email, cursor)
     except Exception as e:
         logging.error(f"Error fetching history: {e}")
         return
 
-    changes_raw = response.get('history')
-    if not changes_raw:
-        logging.info("No new changes")
-        return
+    if not new_message_ids:
+        logging.info("No new messages")
+        return latest_history_id
 
-    # Filter and flatten new messages from history
-    changes_filtered = [d for d in changes_raw if 'messagesAdded' in d]
-    messages_added_values_filtered = list(chain.from_iterable(item['messagesAdded'] for item in changes_filtered))
+    # Drop messages an earlier delivery already handled, before any Gmail or OpenAI call on them
+    claimed_keys = await dedup_store.claim_many([f"gmail:{webhook_email}:{message_id}"
+                                                 for message_id in new_message_ids])
+    if not claimed_keys:
+        logging.info("New messages were already processed")
+        return latest_history_id
 
-    if not messages_added_values_filtered:
-        logging.info("No new messages")
+    try:
+        unprocessed = await label_new_messages(webhook_email, user_labels, service,
+                                               [key.rpartition(':')[2] for key in claimed_keys])
+    except Exception:
+        # Let a redelivery process these messages again
+        await dedup_store.release(claimed_keys)
+        raise
+    retry_keys = []
+    for message_id in unprocessed:
+        key = f"gmail:{webhook_email}:{message_id}"
+        attempts = await dedup_store.count_failure(key)
+        if attempts < SYNC_MESSAGE_MAX_ATTEMPTS:
+            retry_keys.append(key)
+        else:
+            # Keep the key claimed and let the history ID move past it, rather than block the user's syncs
+            logging.error(f"Giving up on message {message_id} of {webhook_email} after {attempts} attempts")
+    if retry_keys:
+        # Keep the history ID, so the next sync lists these messages again and processes them
+        await dedup_store.release(retry_keys)
         return
 
-    # Process each new message
-    for message in messages_added_values_filtered:
-        new_message_id = message['message']['id']
+    return latest_history_id
 
-        # Check if the message is already labeled
-        try:
-            labels = service.users().messages().get(userId='me', id=new_message_id).execute().get('labelIds', [])
-        except Exception as e:
-            logging.error(f"Error checking labels for message {new_message_id}: {e}")
-            continue
 
-        if any(label.startswith('Label_') for label in labels):
-            continue
+async def label_new_messages(webhook_email: str, user_labels: list, service, new_message_ids: list):
+    """
+    Fetches, classifies and labels new messages of @webhook_email.
+    Returns the IDs of the messages that could not be fetched, to be processed again.
+    """
+    # Fetch metadata of all new messages in batched round-trips, once per message
+    failed = []
+    try:
+        emails = await batch_get_metadata(service, webhook_email, new_message_ids, failed=failed)
+    except Exception as e:
+        logging.error(f"Error fetching new messages: {e}")
+        return new_message_ids
 
-        # Retrieve email details using the message ID
-        try:
-            email = service.users().messages().get(userId='me', id=new_message_id).execute()
-        except Exception as e:
-            logging.error(f"Error fetching email details for message {new_message_id}: {e}")
+    # Collect new, unlabeled messages
+    candidates = []
+    for new_message_id, email in emails.items():
+        # Check if the message is already labeled
+        if any(label.startswith('Label_') for label in email.get('labelIds', [])):
             continue
 
-        # Extract subject using next() for better readability
-        subject = next((header['value'] for header in email['payload']['headers'] if header['name'] == 'Subject'), None)
+        subject = get_header(email, 'Subject')
         if not subject:
             logging.warning(f"Subject not found for message {new_message_id}")
             continue
 
         logging.info(f"Subject: {subject}\nEmail Content: {email['snippet']}")
-
-        # Call function to determine label and apply it to the message
-        label = await gpt_call(user_labels, subject, email['snippet'])
-        await label_message(new_message_id, label, credentials_doc)
+        candidates.append((new_message_id, get_header(email, 'From'), subject, email['snippet'],
+                           get_header(email, 'List-Unsubscribe')))
+
+    # Label what the rules can, then what the local model is confident about,
+    # and classify the rest (cached results first, then batched completions)
+    with stage('rules'):
+        rule_labels = await rule_engine.classify(webhook_email, user_labels,
+                                                 [(sender, subject, unsubscribe)
+                                                  for _, sender, subject, _, unsubscribe in candidates])
+    remaining = [candidate for candidate, label in zip(candidates, rule_labels) if not label]
+
+    with stage('local_classifier'):
+        local_labels = await local_classifier.predict(webhook_email, 'label', user_labels,
+                                                      [candidate[1:4] for candidate in remaining])
+    uncertain = [candidate for candidate, label in zip(remaining, local_labels) if not label]
+
+    async def classify(messages):
+        return await gpt_call_batch(user_labels, messages)
+
+    with stage('classify'):
+        gpt_labels = await classify_cached('label', user_labels, [candidate[1:4] for candidate in uncertain],
+                                           classify)
+    await rule_engine.learn(webhook_email,
+                            [(candidate[1], label) for candidate, label in zip(uncertain, gpt_labels)])
+    # Train the local model on the rule and GPT decisions, never on its own predictions
+    labeled = [(candidate, label) for candidate, label in zip(candidates, rule_labels) if label]
+    labeled += list(zip(uncertain, gpt_labels))
+    await local_classifier.learn(webhook_email, 'label', [candidate[1:4] for candidate, _ in labeled],
+                                 [label for _, label in labeled])
+
+    # Apply the labels
+    decisions = [(candidate[0], label) for candidate, label in labeled]
+    decisions += [(candidate[0], label) for candidate, label in zip(remaining, local_labels) if label]
+    for new_message_id, label in decisions:
+        if label:
+            await label_message(new_message_id, label, service, webhook_email)
+
+    # Count the messages in the sender index, with the labels just applied
+    await sender_index.record(webhook_email, list(emails.values()), dict(decisions))
+    return failed
 
 
 async def create_labels(user_chosen_labels: list, user_email: str):
@@ -168,59 +215,63 @@ async def create_labels(user_chosen_labels: list, user_email: str):
         raise HTTPException(status_code=400, detail=f"Credentials not found for user {user_email}")
 
     # Build connection with Gmail API
-    drive = googleapiclient.discovery.build(API_SERVICE_NAME, API_VERSION, credentials=credentials_doc)
-
-    # Get current user labels from Gmail account
-    current_user_labels = drive.users().labels().list(userId='me').execute().get('labels', [])
+    drive = get_gmail_service(user_email, credentials_doc)
 
-    # Extract names of existing labels for comparison
-    filtered_current_user_labels = [label['name'] for label in current_user_labels]
+    # Get names of current user labels from the cached label index
+    filtered_current_user_labels = await label_index.get_names(user_email, drive)
 
     # Loop through user-chosen labels to create new ones if they don't exist
     for label in user_chosen_labels:
         if not label in filtered_current_user_labels:
             # Create new label with specified properties if it doesn't exist
             label_body = label_color_dict[label]
-            drive.users().labels().create(userId='me', body=label_body).execute()
+            created_label = await gmail_scheduler.execute(drive.users().labels().create(userId='me', body=label_body),
+                                                          user_email)
+            label_index.add(user_email, created_label['name'], created_label['id'])
 
 
-async def label_message(message_id: str, label: str, credentials: object):
+async def label_message(message_id: str, label: str, service: object, user_email: str):
     """
     Applies a message to a label.
     """
-    service = googleapiclient.discovery.build('gmail', 'v1', credentials=credentials)
-
-    # Get all labels
-    response = service.users().labels().list(userId='me').execute()
-    user_labels = response.get('labels', [])
-
-    label_id = None
     # Find the label ID based on the label name
-    for label in user_labels:
-        if label['name'] == label:
-            label_id = label['id']
-            break
+    label_id = await label_index.get_id(user_email, service, label)
 
     if label_id:
         # Modify the message to add the label
         label_body = {'addLabelIds': [label_id], 'removeLabelIds': []}
-        modified_message = service.users().messages().modify(userId='me', id=message_id, body=label_body).execute()
+        try:
+            request = service.users().messages().modify(userId='me', id=message_id, body=label_body)
+            modified_message = await gmail_scheduler.execute(request, user_email)
+        except googleapiclient.errors.HttpError as error:
+            if error.resp.status not in (400, 404):
+                raise
+            # The cached label ID may be stale (label deleted or recreated in Gmail)
+            label_index.invalidate(user_email)
+            fresh_label_id = await label_index.get_id(user_email, service, label)
+            if not fresh_label_id or fresh_label_id == label_id:
+                raise
+            label_body['addLabelIds'] = [fresh_label_id]
+            request = service.users().messages().modify(userId='me', id=message_id, body=label_body)
+            modified_message = await gmail_scheduler.execute(request, user_email)
         print(f"Added label '{label}' to message ID: {message_id}")
         return modified_message
     else:
         print(f"Label '{label}' not found.")
 
 
-async def get_create_label(service, user_id, label_name, parent_label_name=None):
+async def get_create_label(service, user_email, label_name, parent_label_name=None):
     """
     Checks if a label exists, if not, creates it. Returns the label ID.
     """
-    labels = service.users().labels().list(userId=user_id).execute().get('labels', [])
+    # If this is a son label, format its name accordingly
+    if parent_label_name:
+        label_name = f"{parent_label_name}/{label_name}"
 
     # Check if label exists
-    for label in labels:
-        if label['type'] == 'user' and label['name'] == label_name:
-            return label['id']
+    label_id = await label_index.get_id(user_email, service, label_name)
+    if label_id:
+        return label_id
 
     # If the label doesn't exist, create it
     new_label = {
@@ -229,97 +280,283 @@ async def get_create_label(service, user_id, label_name, parent_label_name=None)
         'labelListVisibility': 'labelShow'
     }
 
-    # If this is a son label, format its name accordingly
-    if parent_label_name:
-        new_label['name'] = f"{parent_label_name}/{label_name}"
-
-    created_label = service.users().labels().create(userId=user_id, body=new_label).execute()
+    created_label = await gmail_scheduler.execute(service.users().labels().create(userId='me', body=new_label),
+                                                  user_email)
+    label_index.add(user_email, created_label['name'], created_label['id'])
     return created_label['id']
 
 
-async def filter_emails_by_sender(user_email: str, sender_email: str, label_chosen: str, num_of_messages: int):
+def attribute_messages(emails: dict, patterns: list, max_per_sender: int = None):
     """
-    Given a specific sender Email Address, label last @num_of_messages
-    amount of last Emails sent by the sender.
+    Groups fetched @emails by the sender pattern of their From header, keeping at most
+    @max_per_sender of each. With a single pattern, every message belongs to it.
     """
-    # Define email addresses, label, and retrieve user credentials
-    sender_name = sender_email.split('@')[0]
-    credentials_doc = await create_credentials(user_email)
+    by_sender = {pattern: [] for pattern in patterns}
+    for email_id, msg in emails.items():
+        pattern = patterns[0] if len(patterns) == 1 else attribute_sender(get_header(msg, 'From'), patterns)
+        if pattern and (not max_per_sender or len(by_sender[pattern]) < max_per_sender):
+            by_sender[pattern].append(email_id)
+    return by_sender
 
-    if not credentials_doc:
-        raise HTTPException(status_code=400, detail=f"Credentials not found for user {user_email}")
 
-    service = googleapiclient.discovery.build(API_SERVICE_NAME, API_VERSION, credentials=credentials_doc)
+async def get_user_gmail_service(user_email: str):
+    """
+    Returns the Gmail service of @user_email for background work. Raises ValueError without credentials.
+    """
+    credentials_doc = await create_credentials(user_email)
+    if not credentials_doc:
+        raise ValueError(f"Credentials not found for user {user_email}")
+    return get_gmail_service(user_email, credentials_doc)
 
-    # Get IDs of the last X emails from the sender
-    results = service.users().messages().list(userId='me', q=f'from:{sender_email}',
-                                              maxResults=num_of_messages).execute()
-    messages = results.get('messages', [])
 
-    parent_label_id = await get_create_label(service, 'me', sender_name)
+async def sort_sender_messages(service, user_email: str, patterns: list, label_chosen: str, son_labels: list,
+                               num_of_messages: int, message_ids: list, checkpoint: dict):
+    """
+    Classifies and labels one chunk of @message_ids of the past email sorter, skipping messages of
+    senders that already have @num_of_messages. Adds to the counters of @checkpoint and returns
+    the internalDate of the chunk's oldest message.
+    """
+    # Fetch subjects and snippets of all messages, skipping already labeled ones
+    emails = await batch_get_metadata(service, user_email, message_ids, priority=BULK)
+    candidates = []
+    sender_of = {}
+    for email_id, msg in emails.items():
+        pattern = patterns[0] if len(patterns) == 1 else attribute_sender(get_header(msg, 'From'), patterns)
+        if pattern is None or checkpoint["fetched"][patterns.index(pattern)] >= num_of_messages:
+            continue
+        index = patterns.index(pattern)
+        checkpoint["fetched"][index] += 1
+        if son_labels[index][1] in msg.get('labelIds', []):
+            continue
+        subject = get_header(msg, 'Subject')
+        if not subject:
+            logging.warning(f"Subject not found for message {email_id}")
+            continue
+        sender_of[email_id] = index
+        candidates.append((email_id, get_header(msg, 'From'), subject, msg.get('snippet', '')))
+
+    # Answer what the local model is confident about, and classify the rest
+    # (cached results first, then batched completions)
+    namespace = f'filter:{label_chosen}'
+    with stage('local_classifier'):
+        local_answers = await local_classifier.predict(user_email, namespace, ['YES', 'NO'],
+                                                       [candidate[1:] for candidate in candidates])
+    uncertain = [candidate for candidate, answer in zip(candidates, local_answers) if not answer]
+
+    async def classify(messages):
+        return await gpt_call_filter_by_sender_batch(label_chosen, messages)
+
+    with stage('classify'):
+        gpt_answers = await classify_cached('filter', [label_chosen], [candidate[1:] for candidate in uncertain],
+                                            classify, answers=['YES', 'NO'])
+    await local_classifier.learn(user_email, namespace, [candidate[1:] for candidate in uncertain], gpt_answers)
+
+    answers = [(candidate, answer) for candidate, answer in zip(candidates, local_answers) if answer]
+    answers += list(zip(uncertain, gpt_answers))
+    matched = [[] for _ in patterns]
+    for candidate, answer in answers:
+        if answer == 'YES':
+            matched[sender_of[candidate[0]]].append(candidate)
+
+    # Apply each sender's label to all of its matching messages at once
+    for index, matched_candidates in enumerate(matched):
+        if not matched_candidates:
+            continue
+        son_label_name, son_label_id = son_labels[index]
+        await batch_modify(service, user_email, [candidate[0] for candidate in matched_candidates],
+                           add_label_ids=[son_label_id])
+        for address, count in Counter(normalize_sender(candidate[1]) for candidate in matched_candidates).items():
+            await sender_index.record_labels(user_email, address, son_label_name, count)
+        checkpoint["labeled"][index] += len(matched_candidates)
 
-    son_label_name = f"{sender_name}/{label_chosen}"
-    son_label_id = await get_create_label(service, 'me', son_label_name)
+    checkpoint["classified"] += len(candidates)
+    checkpoint["classified_locally"] += len(candidates) - len(uncertain)
+    # The oldest message of the chunk, where a search of the remaining older messages starts
+    return min((int(msg['internalDate']) for msg in emails.values() if msg.get('internalDate')), default=None)
 
-    # Loop through the messages from the sender
-    for message in messages:
-        email_id = message['id']
-        msg = service.users().messages().get(userId='me', id=email_id).execute()
 
-        # If the message is already labeled, skip
-        msg_labels_list = msg.get('labelIds', [])
-        if son_label_id in msg_labels_list:
-            print("Already labeled!")
-            continue
+async def run_past_email_sort_job(job):
+    """
+    Job handler of the past email sorter: given sender Email Addresses or domain wildcards,
+    label the last @messages_amount Emails of each sender under a "<sender>/<label>" label.
+    Senders are searched together, and messages are listed, classified and labeled a page of
+    @JOBS_CHUNK_SIZE at a time, checkpointing the search and its next page token after each page.
+    """
+    patterns = job.params["senders"]
+    label_chosen = job.params["label"]
+    num_of_messages = job.params["messages_amount"]
+    service = await get_user_gmail_service(job.user_email)
+
+    # Create the "<sender>/<label>" labels
+    son_labels = []
+    for pattern in patterns:
+        sender_name = sender_label_name(pattern)
+        await get_create_label(service, job.user_email, sender_name)
+        son_label_name = f"{sender_name}/{label_chosen}"
+        son_labels.append((son_label_name, await get_create_label(service, job.user_email, son_label_name)))
+
+    def progress(checkpoint):
+        return {"processed": checkpoint["processed"], "labeled": sum(checkpoint["labeled"])}
+
+    # Each search is [query, most messages to list, indexes of its senders]
+    searches = []
+    for start, query in zip(range(0, len(patterns), GMAIL_QUERY_MAX_SENDERS), sender_queries(patterns)):
+        indexes = list(range(start, min(start + GMAIL_QUERY_MAX_SENDERS, len(patterns))))
+        searches.append([query, num_of_messages * len(indexes), indexes])
+    checkpoint = job.checkpoint or {
+        "searches": searches, "search": 0, "page_token": None, "listed": 0, "oldest": None, "truncated": [],
+        "topped_up": False, "processed": 0, "fetched": [0] * len(patterns), "labeled": [0] * len(patterns),
+        "classified": 0, "classified_locally": 0,
+    }
 
-        # Extract email subject
-        for header in msg['payload']['headers']:
-            if header['name'] == 'Subject':
-                subject = header['value']
-                break
+    while True:
+        while checkpoint["search"] < len(checkpoint["searches"]):
+            query, limit, indexes = checkpoint["searches"][checkpoint["search"]]
+            page_size = min(JOBS_CHUNK_SIZE, limit - checkpoint["listed"])
+            message_ids, page_token = await list_message_page(service, job.user_email, query, page_size,
+                                                              checkpoint["page_token"], priority=BULK)
+            oldest = await sort_sender_messages(service, job.user_email, patterns, label_chosen, son_labels,
+                                                num_of_messages, message_ids, checkpoint)
+            checkpoint["oldest"] = min(filter(None, [checkpoint["oldest"], oldest]), default=None)
+            checkpoint["listed"] += len(message_ids)
+            checkpoint["processed"] += len(message_ids)
+            checkpoint["page_token"] = page_token
+            if not page_token or checkpoint["listed"] >= limit:
+                if page_token and not checkpoint["topped_up"]:
+                    # Busier senders may have filled the search: older messages of the others are searched alone
+                    checkpoint["truncated"] += [[index, checkpoint["oldest"]] for index in indexes]
+                checkpoint.update(search=checkpoint["search"] + 1, page_token=None, listed=0, oldest=None)
+            await job.save(checkpoint, **progress(checkpoint))
+        if checkpoint["topped_up"]:
+            break
 
-        # Check if subject exists and print email content
-        if 'subject' in locals():
-            # Call function to determine label and apply it to the message
-            if await gpt_call_filter_by_sender(label_chosen, subject, msg['snippet']) == 'Yes':
-                service.users().messages().modify(userId='me', id=email_id,
-                                                  body={'addLabelIds': [son_label_id]}).execute()
-        else:
-            print('Subject not found')
+        for index, oldest in checkpoint["truncated"]:
+            missing = num_of_messages - checkpoint["fetched"][index]
+            if missing > 0 and oldest:
+                query = f"{sender_queries([patterns[index]])[0]} before:{oldest // 1000}"
+                checkpoint["searches"].append([query, missing, [index]])
+        checkpoint["topped_up"] = True
+        await job.save(checkpoint, **progress(checkpoint))
+
+    fetched = sum(checkpoint["fetched"])
+    return {
+        "fetched": fetched,
+        "already_labeled": fetched - checkpoint["classified"],
+        "classified": checkpoint["classified"],
+        "classified_locally": checkpoint["classified_locally"],
+        "labeled": sum(checkpoint["labeled"]),
+        "senders": [{"sender": pattern, "fetched": fetched, "labeled": labeled}
+                    for pattern, fetched, labeled in zip(patterns, checkpoint["fetched"], checkpoint["labeled"])],
+    }
 
 
-async def fetch_historyId_update_webhook(data):
+async def get_sender_stats(user_email: str, limit: int, sort_by: str):
     """
-    checks for the user email inside @data, if user in database -
-    returns stored history id and updates to new history id.
+    Returns the top senders of @user_email from the sender index, and the state of its backfill.
+    The backfill is started in the background the first time the index is requested.
     """
-    user_email = data["emailAddress"]
-    new_history_id = data["historyId"]
-    filter_criteria = {"email": user_email}
-    update_data = {"$set": {"historyId": new_history_id}}
-    db_users.update_one(filter_criteria, update_data, upsert=True)
-    return new_history_id if not db_users.find_one({"email": user_email}).get("historyId") else data["historyId"]
+    state = await sender_index.ensure_backfill(user_email, lambda: get_user_gmail_service(user_email))
+    senders = await sender_index.top_senders(user_email, limit, sort_by)
+    return {"index": state, "senders": senders}
 
 
-async def delete_emails_by_sender(user_email: str, sender_email: str):
+async def advance_history_id(user_email: str, history_id: int):
     """
-    Deletes last 500 Emails sent by a certain sender.
+    Atomically moves the stored history ID of @user_email forward to @history_id, never backwards.
     """
-    credentials_doc = await create_credentials(user_email)
+    await db_users.update_one({"email": user_email}, {"$max": {"historyId": history_id}})
 
-    if not credentials_doc:
-        raise HTTPException(status_code=400, detail=f"Credentials not found for user {user_email}")
 
-    service = googleapiclient.discovery.build(API_SERVICE_NAME, API_VERSION, credentials=credentials_doc)
-    try:
-        results = service.users().messages().list(userId='me', q=f'from:{sender_email}', maxResults=500).execute()
-        messages = results.get('messages', [])
-        # Delete the last X emails from the sender
-        if messages:
-            for message in messages:
-                message_id = message['id']
-                service.users().messages().delete(userId='me', id=message_id).execute()
-
-    except googleapiclient.errors.HttpError as error:
-        print(f"An error occurred: {error}")
-    return f"Mails from {sender_email} were deleted!"
+async def process_notifications(user_email: str, notifications: list):
+    """
+    Handles the queued Gmail Pub/Sub notifications of a user as a single sync:
+    labels the messages added since the stored history ID (the lowest notified one
+    if none is stored yet), then advances the stored history ID once.
+    The sync runs under the user's lease; if another worker holds it, the user is left pending.
+    """
+    history_ids = [int(notification["historyId"]) for notification in notifications]
+    with route_context('webhook_worker'), stage('webhook.sync'):
+        # Only one worker syncs a user at a time, so two never race on the same history
+        async with sync_leases.hold(f"sync:{user_email}") as lease:
+            if lease is None:
+                # Still being synced elsewhere, e.g. while its ownership moves: retry once it is free
+                await sync_coordinator.defer(user_email, min(history_ids))
+                return
+            latest_history_id = await get_email_from_watch(user_email, min(history_ids))
+            # A worker that lost its lease leaves the cursor to the new holder
+            if latest_history_id and not lease.lost:
+                await advance_history_id(user_email, latest_history_id)
+
+
+async def run_bulk_remove_job(job):
+    """
+    Job handler of bulk removal: deletes all Emails sent by the given senders or domain wildcards,
+    or moves them to trash if @move_to_trash. Senders are searched together and removed a page
+    at a time, checkpointing the search reached and the IDs of the last removed page.
+    A search that shows nothing but removed messages is followed to its next pages, and
+    searched again once after @JOBS_RELIST_DELAY_SECONDS before moving to the next one.
+    """
+    patterns = job.params["senders"]
+    move_to_trash = job.params["move_to_trash"]
+    service = await get_user_gmail_service(job.user_email)
+    queries = sender_queries(patterns)
+
+    checkpoint = job.checkpoint or {"query": 0, "processed": [], "matched": 0, "removed": 0,
+                                    "senders": [0] * len(patterns), "unattributed": 0}
+    relisted = False
+    while checkpoint["query"] < len(queries):
+        # Removed messages drop out of the search, so the first page is normally the next one,
+        # but the search may lag behind: pages showing only removed messages are skipped
+        processed = set(checkpoint["processed"])
+        page_token = None
+        stale = False
+        while True:
+            message_ids, page_token = await list_message_page(service, job.user_email, queries[checkpoint["query"]],
+                                                              GMAIL_LIST_PAGE_SIZE, page_token, priority=BULK)
+            page = [message_id for message_id in message_ids if message_id not in processed]
+            stale = stale or len(page) < len(message_ids)
+            if page or not page_token:
+                break
+        if not page and stale and not relisted:
+            # Messages hidden behind the removed ones may not be searchable yet
+            relisted = True
+            await asyncio.sleep(JOBS_RELIST_DELAY_SECONDS)
+            continue
+        relisted = False
+        if not page:
+            checkpoint["query"] += 1
+            checkpoint["processed"] = []
+            await job.save(checkpoint, matched=checkpoint["matched"], removed=checkpoint["removed"])
+            continue
+
+        if len(patterns) == 1:
+            checkpoint["senders"][0] += len(page)
+        else:
+            # Attribute the messages to their senders from the From header only
+            emails = await batch_get_metadata(service, job.user_email, page, headers=['From'], priority=BULK)
+            for pattern, ids in attribute_messages(emails, patterns).items():
+                checkpoint["senders"][patterns.index(pattern)] += len(ids)
+                # Matched by Gmail on the sender's name rather than its address
+                checkpoint["unattributed"] -= len(ids)
+            checkpoint["unattributed"] += len(page)
+
+        if move_to_trash:
+            removed = await batch_modify(service, job.user_email, page, add_label_ids=['TRASH'],
+                                         remove_label_ids=['INBOX'])
+        else:
+            removed = await batch_delete(service, job.user_email, page)
+        checkpoint["matched"] += len(page)
+        checkpoint["removed"] += removed
+        checkpoint["processed"] = page
+        await job.save(checkpoint, matched=checkpoint["matched"], removed=checkpoint["removed"])
+
+    if checkpoint["matched"] and checkpoint["removed"] == checkpoint["matched"]:
+        await sender_index.remove_senders(job.user_email, patterns)
+    return {
+        "sender_emails": patterns,
+        "mode": "trash" if move_to_trash else "delete",
+        "matched": checkpoint["matched"],
+        "removed": checkpoint["removed"],
+        "senders": [{"sender": pattern, "matched": count} for pattern, count in zip(patterns, checkpoint["senders"])],
+        "unattributed": checkpoint["unattributed"],
+    }
@@ -0,0 +1,122 @@
+import logging
+
+import googleapiclient.errors
+
+from config import GMAIL_BATCH_SIZE, GMAIL_LIST_PAGE_SIZE, GMAIL_BATCH_MODIFY_SIZE, GMAIL_MAX_RETRIES
+from gmail_scheduler import gmail_scheduler, is_rate_limited, METHOD_COSTS, INTERACTIVE, BULK
+
+METADATA_HEADERS = ['Subject', 'From', 'List-Unsubscribe']
+METADATA_FIELDS = 'id,threadId,labelIds,snippet,sizeEstimate,internalDate,payload/headers'
+
+
+async def batch_get_metadata(service, user_email: str, message_ids: list, headers: list = None,
+                             priority: int = INTERACTIVE, failed: list = None):
+    """
+    Fetches the metadata (labels, snippet and selected headers) of @message_ids through
+    the Gmail batch endpoint, @GMAIL_BATCH_SIZE messages per round-trip.
+    Rate-limited messages are fetched again after the user's backoff.
+    Returns a dict of message ID to message, in the order of @message_ids.
+    Messages that failed to fetch are logged and left out; the IDs of those that still
+    exist (not deleted meanwhile) are appended to @failed.
+    """
+    headers = headers or METADATA_HEADERS
+    unique_ids = list(dict.fromkeys(message_ids))
+    fetched = {}
+    rate_limited = []
+    deleted = set()
+
+    def callback(request_id, response, exception):
+        if exception:
+            if is_rate_limited(exception):
+                rate_limited.append(request_id)
+            elif isinstance(exception, googleapiclient.errors.HttpError) and exception.resp.status == 404:
+                deleted.add(request_id)
+            else:
+                logging.error(f"Error fetching message {request_id}: {exception}")
+            return
+        fetched[request_id] = response
+
+    pending = unique_ids
+    for attempt in range(GMAIL_MAX_RETRIES + 1):
+        for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+            chunk = pending[start:start + GMAIL_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in chunk:
+                batch.add(service.users().messages().get(userId='me', id=message_id, format='metadata',
+                                                         metadataHeaders=headers, fields=METADATA_FIELDS),
+                          request_id=message_id)
+            await gmail_scheduler.execute(batch, user_email, priority,
+                                          cost=METHOD_COSTS['gmail.users.messages.get'] * len(chunk))
+        if not rate_limited:
+            break
+        gmail_scheduler.report_rate_limited(user_email)
+        pending, rate_limited = rate_limited, []
+    else:
+        logging.error(f"Gave up fetching {len(pending)} rate-limited messages of {user_email}")
+
+    if failed is not None:
+        failed.extend(message_id for message_id in unique_ids
+                      if message_id not in fetched and message_id not in deleted)
+    return {message_id: fetched[message_id] for message_id in unique_ids if message_id in fetched}
+
+
+def get_header(message: dict, name: str):
+    """
+    Returns the value of header @name of a fetched message, or None.
+    """
+    headers = message.get('payload', {}).get('headers', [])
+    return next((header['value'] for header in headers if header['name'].lower() == name.lower()), None)
+
+
+async def list_message_ids(service, user_email: str, query: str = None, max_results: int = None,
+                           label_ids: list = None, priority: int = INTERACTIVE):
+    """
+    Returns the IDs of all messages matching @query and @label_ids, following nextPageToken.
+    Stops after @max_results IDs when given.
+    """
+    message_ids = []
+    page_token = None
+    while True:
+        page_size = GMAIL_LIST_PAGE_SIZE
+        if max_results:
+            page_size = min(page_size, max_results - len(message_ids))
+        page, page_token = await list_message_page(service, user_email, query, page_size, page_token, label_ids,
+                                                   priority)
+        message_ids.extend(page)
+        if not page_token or (max_results and len(message_ids) >= max_results):
+            return message_ids
+
+
+async def list_message_page(service, user_email: str, query: str = None, page_size: int = GMAIL_LIST_PAGE_SIZE,
+                            page_token: str = None, label_ids: list = None, priority: int = INTERACTIVE):
+    """
+    Returns one page of up to @page_size IDs of messages matching @query, and the token of the next page or None.
+    """
+    request = service.users().messages().list(userId='me', q=query, labelIds=label_ids, maxResults=page_size,
+                                              pageToken=page_token)
+    results = await gmail_scheduler.execute(request, user_email, priority)
+    return [message['id'] for message in results.get('messages', [])], results.get('nextPageToken')
+
+
+async def batch_delete(service, user_email: str, message_ids: list, priority: int = BULK):
+    """
+    Permanently deletes @message_ids in batchDelete chunks. Returns the number of deleted messages.
+    """
+    for start in range(0, len(message_ids), GMAIL_BATCH_MODIFY_SIZE):
+        chunk = message_ids[start:start + GMAIL_BATCH_MODIFY_SIZE]
+        await gmail_scheduler.execute(service.users().messages().batchDelete(userId='me', body={'ids': chunk}),
+                                      user_email, priority)
+    return len(message_ids)
+
+
+async def batch_modify(service, user_email: str, message_ids: list, add_label_ids: list = None,
+                       remove_label_ids: list = None, priority: int = BULK):
+    """
+    Adds/removes labels on @message_ids in batchModify chunks. Returns the number of modified messages.
+    """
+    body = {'addLabelIds': add_label_ids or [], 'removeLabelIds': remove_label_ids or []}
+    for start in range(0, len(message_ids), GMAIL_BATCH_MODIFY_SIZE):
+        chunk = message_ids[start:start + GMAIL_BATCH_MODIFY_SIZE]
+        request = service.users().messages().batchModify(userId='me', body={**body, 'ids': chunk})
+        await gmail_scheduler.execute(request, user_email, priority)
+    return len(message_ids)
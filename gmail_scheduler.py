@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+
+import googleapiclient.errors
+
+from config import GMAIL_USER_UNITS_PER_SECOND, GMAIL_PROJECT_UNITS_PER_SECOND, GMAIL_BULK_RESERVE_FRACTION, \
+    GMAIL_MAX_RETRIES, GMAIL_BACKOFF_BASE_SECONDS, GMAIL_BACKOFF_MAX_SECONDS
+from metrics import stage
+
+# Request priorities - bulk jobs leave part of the quota to interactive/webhook work
+INTERACTIVE = 0
+BULK = 1
+
+# Quota units charged per Gmail API method
+METHOD_COSTS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.watch': 100,
+    'gmail.users.stop': 50,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.get': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.trash': 5,
+    'gmail.users.messages.delete': 10,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.batchDelete': 50,
+}
+DEFAULT_COST = 5
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_rate_limited(error):
+    if not isinstance(error, googleapiclient.errors.HttpError):
+        return False
+    return error.resp.status == 429 or (error.resp.status == 403
+                                        and b'ratelimitexceeded' in (error.content or b'').lower())
+
+
+def is_retryable(error):
+    return is_rate_limited(error) or (isinstance(error, googleapiclient.errors.HttpError)
+                                      and error.resp.status in RETRY_STATUS_CODES)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at @rate units per second, holding up to @capacity units.
+    The rate adapts: it is halved on rate limiting and recovers gradually on success.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def wait_time(self, cost: float, reserve: float = 0.0):
+        """
+        Returns the seconds until @cost units can be taken while leaving @reserve units free.
+        Requests larger than the bucket only need a full bucket and leave it in debt.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        need = min(cost + reserve, self.capacity)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= cost
+
+    def slow_down(self):
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class _UserState:
+    def __init__(self, rate: float):
+        self.bucket = TokenBucket(rate)
+        # httplib2 transports are not thread-safe, so a user's calls run one at a time
+        self.transport_lock = asyncio.Lock()
+        self.backoff_until = 0.0
+        self.strikes = 0
+
+
+class GmailScheduler:
+    """
+    Runs Gmail API requests off the event loop within per-user and project-wide quota budgets,
+    tracked in this process only.
+    Each request is charged its method's unit cost against both token buckets. Bulk requests
+    must leave @reserve_fraction of each bucket free. Rate-limit responses put the user in
+    exponential backoff with jitter and halve its rate.
+    """
+
+    def __init__(self, user_rate: float = GMAIL_USER_UNITS_PER_SECOND,
+                 project_rate: float = GMAIL_PROJECT_UNITS_PER_SECOND,
+                 reserve_fraction: float = GMAIL_BULK_RESERVE_FRACTION, max_retries: int = GMAIL_MAX_RETRIES,
+                 max_users: int = 10000):
+        self.user_rate = user_rate
+        self.reserve_fraction = reserve_fraction
+        self.max_retries = max_retries
+        self.max_users = max_users
+        self.project_bucket = TokenBucket(project_rate)
+        self.requests = 0
+        self.units = 0
+        self.waits = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self._users = OrderedDict()
+
+    async def acquire(self, user_email: str, cost: float, priority: int = INTERACTIVE):
+        """
+        Waits until @cost quota units are available for @user_email and takes them.
+        """
+        user = self._user(user_email)
+        reserve = self.reserve_fraction if priority == BULK else 0.0
+        while True:
+            wait = max(user.bucket.wait_time(cost, reserve * user.bucket.capacity),
+                       self.project_bucket.wait_time(cost, reserve * self.project_bucket.capacity),
+                       user.backoff_until - time.monotonic())
+            if wait <= 0:
+                user.bucket.take(cost)
+                self.project_bucket.take(cost)
+                self.units += cost
+                return
+            self.waits += 1
+            await asyncio.sleep(wait)
+
+    async def execute(self, request, user_email: str, priority: int = INTERACTIVE, cost: float = None):
+        """
+        Executes a Gmail API (or batch) @request for @user_email, retrying rate-limited and 5xx responses.
+        @cost defaults to the unit cost of the request's method.
+        """
+        method_id = getattr(request, 'methodId', None) or 'batch'
+        cost = cost or METHOD_COSTS.get(method_id, DEFAULT_COST)
+        user = self._user(user_email)
+        for attempt in range(self.max_retries + 1):
+            with stage('gmail.quota_wait'):
+                await self.acquire(user_email, cost, priority)
+            try:
+                async with user.transport_lock:
+                    self.requests += 1
+                    with stage(f"gmail.{method_id.rpartition('users.')[2]}"):
+                        result = await asyncio.to_thread(request.execute)
+            except googleapiclient.errors.HttpError as error:
+                if not is_retryable(error) or attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                if is_rate_limited(error):
+                    self.report_rate_limited(user_email)
+                else:
+                    user.backoff_until = time.monotonic() + self._backoff(attempt)
+                logging.warning(f"Gmail request for {user_email} failed ({error.resp.status}), retrying")
+                continue
+            self.report_success(user_email)
+            return result
+
+    def report_rate_limited(self, user_email: str):
+        """
+        Backs off @user_email after Gmail answered with a rate limit error.
+        """
+        user = self._user(user_email)
+        self.rate_limited += 1
+        user.strikes += 1
+        user.bucket.slow_down()
+        user.backoff_until = time.monotonic() + self._backoff(user.strikes - 1)
+
+    def report_success(self, user_email: str):
+        user = self._user(user_email)
+        user.strikes = 0
+        user.bucket.speed_up()
+
+    def stats(self):
+        return {
+            "users": len(self._users),
+            "requests": self.requests,
+            "units": self.units,
+            "waits": self.waits,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+        }
+
+    @staticmethod
+    def _backoff(attempt: int):
+        return random.uniform(0.5, 1.0) * min(GMAIL_BACKOFF_MAX_SECONDS, GMAIL_BACKOFF_BASE_SECONDS * 2 ** attempt)
+
+    def _user(self, user_email: str):
+        user = self._users.get(user_email)
+        if user is None:
+            user = self._users[user_email] = _UserState(self.user_rate)
+            while len(self._users) > self.max_users:
+                oldest_email, oldest = next(iter(self._users.items()))
+                if oldest.transport_lock.locked():
+                    break
+                del self._users[oldest_email]
+        self._users.move_to_end(user_email)
+        return user
+
+
+gmail_scheduler = GmailScheduler()
@@ -0,0 +1,130 @@
+import importlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from config import API_SERVICE_NAME, API_VERSION, GMAIL_SERVICE_POOL_SIZE, GMAIL_SERVICE_TTL_SECONDS, \
+    GMAIL_HTTP_TIMEOUT_SECONDS
+
+# Vendored copy of the Gmail discovery document, so building a service needs no fetch or file lookup
+DISCOVERY_DOCUMENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "discovery",
+                                       f"{API_SERVICE_NAME}.{API_VERSION}.json")
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+
+class GmailServicePool:
+    """
+    Bounded LRU pool of built Gmail service objects keyed by user email.
+    Each service keeps its own authorized HTTP transport, so connections are reused
+    between calls. Entries expire after @ttl seconds and are rebuilt when the user's
+    access token changes.
+    """
+
+    def __init__(self, max_size: int = GMAIL_SERVICE_POOL_SIZE, ttl: int = GMAIL_SERVICE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_email: str, credentials):
+        """
+        Returns a Gmail service for @user_email, building a new one on a miss.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_email)
+            if entry:
+                service, token, created_at = entry
+                if token == credentials.token and now - created_at < self.ttl:
+                    self._entries.move_to_end(user_email)
+                    self.hits += 1
+                    return service
+                # Expired or credentials rotated - drop the stale service
+                del self._entries[user_email]
+                self.evictions += 1
+            self.misses += 1
+
+        service = build_gmail_service(credentials)
+
+        with self._lock:
+            self._entries[user_email] = (service, credentials.token, now)
+            self._entries.move_to_end(user_email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return service
+
+    def invalidate(self, user_email: str):
+        """
+        Drops the pooled service of @user_email (e.g. after a token refresh).
+        """
+        with self._lock:
+            if self._entries.pop(user_email, None):
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def load_discovery_document():
+    """
+    Returns the vendored Gmail discovery document, parsed once per process.
+    """
+    global _discovery_document
+    if _discovery_document is None:
+        with _discovery_lock:
+            if _discovery_document is None:
+                with open(DISCOVERY_DOCUMENT_PATH) as document:
+                    _discovery_document = json.load(document)
+    return _discovery_document
+
+
+def build_gmail_service(credentials):
+    """
+    Builds a Gmail service bound to a dedicated, keep-alive HTTP transport.
+    """
+    # The Google client libraries are imported on first use to keep worker startup fast
+    import googleapiclient.discovery
+    import google_auth_httplib2
+    import httplib2
+
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT_SECONDS))
+    # The parsed document is shared: the fix-ups build_from_document applies to it are idempotent
+    return googleapiclient.discovery.build_from_document(load_discovery_document(), http=http)
+
+
+def preload():
+    """
+    Imports the Google client libraries and parses the discovery document ahead of the first request.
+    Blocking - run it in a thread after startup.
+    """
+    # Only loaded here; build_gmail_service and credential_cache import them where they are used
+    for module in ('googleapiclient.discovery', 'google_auth_httplib2', 'google.oauth2.credentials',
+                   'google.auth.transport.requests'):
+        importlib.import_module(module)
+
+    load_discovery_document()
+
+
+gmail_service_pool = GmailServicePool()
+
+
+def get_gmail_service(user_email: str, credentials):
+    return gmail_service_pool.get(user_email, credentials)
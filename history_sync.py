@@ -0,0 +1,64 @@
+import logging
+
+import googleapiclient.errors
+
+from config import HISTORY_RESYNC_LIMIT, GMAIL_LIST_PAGE_SIZE
+from gmail_batch import list_message_ids
+from gmail_scheduler import gmail_scheduler
+
+
+class HistoryExpiredError(Exception):
+    pass
+
+
+async def list_added_message_ids(service, user_email: str, start_history_id: int):
+    """
+    Returns the IDs of INBOX messages added after @start_history_id, across all history pages,
+    along with the mailbox history ID the listing reached.
+    Raises HistoryExpiredError if Gmail no longer keeps history that old.
+    """
+    message_ids = []
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        try:
+            request = service.users().history().list(userId='me', startHistoryId=start_history_id,
+                                                     historyTypes=['messageAdded'], labelId='INBOX',
+                                                     maxResults=GMAIL_LIST_PAGE_SIZE, pageToken=page_token)
+            response = await gmail_scheduler.execute(request, user_email)
+        except googleapiclient.errors.HttpError as error:
+            if error.resp.status == 404:
+                raise HistoryExpiredError(f"History ID {start_history_id} is no longer available")
+            raise
+
+        for change in response.get('history', []):
+            message_ids.extend(added['message']['id'] for added in change.get('messagesAdded', []))
+        latest_history_id = max(latest_history_id, int(response.get('historyId', latest_history_id)))
+
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return list(dict.fromkeys(message_ids)), latest_history_id
+
+
+async def resync_message_ids(service, user_email: str, limit: int = HISTORY_RESYNC_LIMIT):
+    """
+    Full resync fallback: returns the IDs of the @limit most recent INBOX messages
+    and the current mailbox history ID to continue from.
+    """
+    # Read the history ID first, so changes made while listing are picked up by the next sync
+    profile = await gmail_scheduler.execute(service.users().getProfile(userId='me'), user_email)
+    latest_history_id = int(profile['historyId'])
+    message_ids = await list_message_ids(service, user_email, label_ids=['INBOX'], max_results=limit)
+    return message_ids, latest_history_id
+
+
+async def sync_new_messages(service, user_email: str, cursor: int):
+    """
+    Returns the IDs of the INBOX messages added since history ID @cursor and the new cursor.
+    Falls back to a bounded full resync when @cursor has expired.
+    """
+    try:
+        return await list_added_message_ids(service, user_email, cursor)
+    except HistoryExpiredError as error:
+        logging.warning(f"{user_email}: {error}, resyncing the last {HISTORY_RESYNC_LIMIT} INBOX messages")
+        return await resync_message_ids(service, user_email)
@@ -0,0 +1,313 @@
+import asyncio
+import datetime
+import logging
+import uuid
+
+import pymongo
+import pymongo.errors
+from pymongo import ReturnDocument
+
+from config import JOBS_MAX_RUNNING, JOBS_MAX_RUNNING_PER_USER, JOBS_MAX_ACTIVE_PER_USER, JOBS_POLL_SECONDS, \
+    JOBS_HEARTBEAT_SECONDS, JOBS_STALE_SECONDS, JOBS_RETENTION_SECONDS
+from database import db_jobs
+from coordination import WORKER_ID, LeaseManager
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+# Fields of a job returned by the API
+PUBLIC_FIELDS = {"_id": 1, "kind": 1, "status": 1, "progress": 1, "result": 1, "error": 1, "createdAt": 1,
+                 "startedAt": 1, "finishedAt": 1, "cancelRequested": 1}
+
+
+class JobLimitError(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def public(document: dict):
+    """
+    Returns the API view of a job document, with the ID as "job_id".
+    """
+    view = {key: value for key, value in document.items() if key in PUBLIC_FIELDS and key != "_id"}
+    return {"job_id": document["_id"], **view}
+
+
+class Job:
+    """
+    A running job as seen by its handler: @params from the request, the last saved @checkpoint
+    (empty on the first run) and save() to persist progress.
+    """
+
+    def __init__(self, manager, document: dict):
+        self.manager = manager
+        self.id = document["_id"]
+        self.user_email = document["userEmail"]
+        self.kind = document["kind"]
+        self.params = document["params"]
+        self.checkpoint = document.get("checkpoint") or {}
+        self.cancel_requested = document.get("cancelRequested", False)
+
+    async def save(self, checkpoint: dict, **progress):
+        """
+        Persists @checkpoint, from which the handler resumes after a restart, and the @progress shown to users.
+        Raises JobCancelled when the user asked to cancel the job, or when it was deleted with the account.
+        """
+        self.checkpoint = checkpoint
+        document = await self.manager.collection.find_one_and_update(
+            {"_id": self.id},
+            {"$set": {"checkpoint": checkpoint, "progress": progress, "heartbeatAt": _now()}},
+            projection={"cancelRequested": 1}, return_document=ReturnDocument.AFTER)
+        self.manager.publish(self.id)
+        if self.cancel_requested or document is None or document.get("cancelRequested"):
+            raise JobCancelled()
+
+
+class JobManager:
+    """
+    Runs long mailbox operations as background jobs persisted in Mongo.
+    Jobs are claimed from the queue every @poll_interval seconds (and right after a submission),
+    at most @max_running per worker and @max_running_per_user per user across workers:
+    a job runs under one of the user's @max_running_per_user slot leases.
+    Handlers save checkpoints as they go; a job whose worker stopped sending heartbeats
+    for @stale_after seconds is queued again and resumed from its last checkpoint.
+    """
+
+    def __init__(self, handlers: dict, collection=db_jobs, max_running: int = JOBS_MAX_RUNNING,
+                 max_running_per_user: int = JOBS_MAX_RUNNING_PER_USER,
+                 max_active_per_user: int = JOBS_MAX_ACTIVE_PER_USER, poll_interval: float = JOBS_POLL_SECONDS,
+                 heartbeat_interval: float = JOBS_HEARTBEAT_SECONDS, stale_after: float = JOBS_STALE_SECONDS):
+        self.handlers = handlers
+        self.collection = collection
+        self.max_running = max_running
+        self.max_running_per_user = max_running_per_user
+        self.max_active_per_user = max_active_per_user
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.worker_id = WORKER_ID
+        self.leases = LeaseManager(ttl=stale_after)
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.resumed = 0
+        self._running = {}
+        self._slots = set()
+        self._changed = {}
+        self._wakeup = None
+        self._tasks = []
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        try:
+            await self.collection.create_index([("status", pymongo.ASCENDING), ("createdAt", pymongo.ASCENDING)])
+            await self.collection.create_index([("userEmail", pymongo.ASCENDING), ("status", pymongo.ASCENDING)])
+            await self.collection.create_index("finishedAt", expireAfterSeconds=JOBS_RETENTION_SECONDS)
+        except pymongo.errors.PyMongoError as error:
+            logging.error(f"Failed to create job indexes: {error}")
+        self._tasks = [asyncio.create_task(self._poll()), asyncio.create_task(self._heartbeat())]
+
+    async def stop(self):
+        """
+        Stops claiming jobs and interrupts the running ones, which are queued again to resume from their checkpoint.
+        """
+        for task in self._tasks + list(self._running.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._running.values(), return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, user_email: str, kind: str, params: dict):
+        """
+        Queues a @kind job for @user_email and returns its API view.
+        Raises JobLimitError when the user already has @max_active_per_user unfinished jobs.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind {kind}")
+        active = await self.collection.count_documents({"userEmail": user_email, "status": {"$in": [QUEUED, RUNNING]}})
+        if active >= self.max_active_per_user:
+            raise JobLimitError(f"{user_email} already has {active} unfinished jobs")
+
+        document = {"_id": uuid.uuid4().hex, "userEmail": user_email, "kind": kind, "params": params,
+                    "status": QUEUED, "progress": {}, "checkpoint": {}, "createdAt": _now()}
+        await self.collection.insert_one(document)
+        self._wakeup.set()
+        return public(document)
+
+    async def get(self, job_id: str, user_email: str):
+        """
+        Returns the API view of job @job_id if it belongs to @user_email, else None.
+        """
+        document = await self.collection.find_one({"_id": job_id, "userEmail": user_email}, PUBLIC_FIELDS)
+        return public(document) if document else None
+
+    async def list_jobs(self, user_email: str, limit: int = 20):
+        cursor = self.collection.find({"userEmail": user_email}, PUBLIC_FIELDS)
+        return [public(document) for document in
+                await cursor.sort("createdAt", pymongo.DESCENDING).limit(limit).to_list(length=limit)]
+
+    async def cancel(self, job_id: str, user_email: str):
+        """
+        Cancels a queued job at once, or asks a running one to stop at its next checkpoint.
+        Returns the job's API view, or None if there is no such job.
+        """
+        document = await self.collection.find_one_and_update(
+            {"_id": job_id, "userEmail": user_email, "status": QUEUED},
+            {"$set": {"status": CANCELLED, "cancelRequested": True, "finishedAt": _now()}},
+            projection=PUBLIC_FIELDS, return_document=ReturnDocument.AFTER)
+        if document:
+            self.cancelled += 1
+        else:
+            document = await self.collection.find_one_and_update(
+                {"_id": job_id, "userEmail": user_email, "status": RUNNING}, {"$set": {"cancelRequested": True}},
+                projection=PUBLIC_FIELDS, return_document=ReturnDocument.AFTER)
+        if not document:
+            # Already finished
+            document = await self.collection.find_one({"_id": job_id, "userEmail": user_email}, PUBLIC_FIELDS)
+        self.publish(job_id)
+        return public(document) if document else None
+
+    async def events(self, job_id: str, user_email: str):
+        """
+        Yields the API view of a job every time it changes, until it is finished.
+        Updates made by this worker are pushed; others are picked up every @poll_interval seconds.
+        """
+        last = None
+        while True:
+            changed = self._changed.setdefault(job_id, asyncio.Event())
+            view = await self.get(job_id, user_email)
+            if view is None:
+                return
+            if view != last:
+                yield view
+                last = view
+            if view["status"] in FINISHED:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def publish(self, job_id: str):
+        changed = self._changed.pop(job_id, None)
+        if changed:
+            changed.set()
+
+    def stats(self):
+        return {
+            "running": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "resumed": self.resumed,
+        }
+
+    async def _poll(self):
+        while True:
+            try:
+                await self._requeue_stale()
+                await self._claim()
+            except Exception as error:
+                logging.error(f"Error polling jobs: {error}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _requeue_stale(self):
+        stale_before = _now() - datetime.timedelta(seconds=self.stale_after)
+        result = await self.collection.update_many({"status": RUNNING, "heartbeatAt": {"$lt": stale_before}},
+                                                   {"$set": {"status": QUEUED, "workerId": None}})
+        self.resumed += result.modified_count
+
+    async def _claim(self):
+        queued = self.collection.find({"status": QUEUED}, {"_id": 1, "userEmail": 1}).sort("createdAt",
+                                                                                        pymongo.ASCENDING)
+        async for candidate in queued:
+            if len(self._running) >= self.max_running:
+                return
+            slot = await self._acquire_slot(candidate["userEmail"])
+            if slot is None:
+                continue
+            try:
+                document = await self.collection.find_one_and_update(
+                    {"_id": candidate["_id"], "status": QUEUED},
+                    {"$set": {"status": RUNNING, "workerId": self.worker_id, "heartbeatAt": _now(),
+                              "startedAt": _now()}},
+                    return_document=ReturnDocument.AFTER)
+            except BaseException:
+                await self._release_slot(slot)
+                raise
+            if document:
+                self._running[document["_id"]] = asyncio.create_task(self._run(document, slot))
+            else:
+                # Claimed by another worker
+                await self._release_slot(slot)
+
+    async def _acquire_slot(self, user_email: str):
+        """
+        Returns a free one of the @max_running_per_user slot leases of @user_email, or None when all are taken.
+        """
+        for slot in range(self.max_running_per_user):
+            key = f"job:{user_email}:{slot}"
+            # acquire() lets a worker take its own leases again, so our own slots are skipped here
+            if key in self._slots:
+                continue
+            lease = await self.leases.acquire(key)
+            if lease:
+                self._slots.add(key)
+                return lease
+        return None
+
+    async def _release_slot(self, lease):
+        self._slots.discard(lease.key)
+        await self.leases.release(lease)
+
+    async def _run(self, document: dict, slot):
+        job = Job(self, document)
+        update = {}
+        try:
+            async with self.leases.keep(slot):
+                result = await self.handlers[job.kind](job)
+            update = {"status": COMPLETED, "result": result}
+            self.completed += 1
+        except JobCancelled:
+            update = {"status": CANCELLED}
+            self.cancelled += 1
+        except asyncio.CancelledError:
+            # Shutting down: leave the job to be resumed from its checkpoint
+            await self.collection.update_one({"_id": job.id, "workerId": self.worker_id},
+                                             {"$set": {"status": QUEUED, "workerId": None}})
+            raise
+        except Exception as error:
+            logging.error(f"Job {job.id} ({job.kind}) of {job.user_email} failed: {error}")
+            update = {"status": FAILED, "error": str(error)}
+            self.failed += 1
+        finally:
+            del self._running[job.id]
+            self._slots.discard(slot.key)
+        await self.collection.update_one({"_id": job.id}, {"$set": {**update, "finishedAt": _now()}})
+        self.publish(job.id)
+        # A slot is free: the user's next job may start
+        self._wakeup.set()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if self._running:
+                try:
+                    await self.collection.update_many({"_id": {"$in": list(self._running)}},
+                                                      {"$set": {"heartbeatAt": _now()}})
+                except Exception as error:
+                    logging.error(f"Failed to record job heartbeats: {error}")
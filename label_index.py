@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+
+from config import LABEL_INDEX_SIZE, LABEL_INDEX_MIN_REFRESH_SECONDS
+from gmail_scheduler import gmail_scheduler
+
+
+class LabelIndex:
+    """
+    Per-user cache of Gmail label names to label IDs.
+    A user's labels are listed once and then kept up to date in place when labels are created.
+    Unknown names trigger a lazy re-listing, at most once every @min_refresh_interval seconds.
+    """
+
+    def __init__(self, max_size: int = LABEL_INDEX_SIZE, min_refresh_interval: int = LABEL_INDEX_MIN_REFRESH_SECONDS):
+        self.max_size = max_size
+        self.min_refresh_interval = min_refresh_interval
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries = OrderedDict()
+
+    async def get_id(self, user_email: str, service, label_name: str):
+        """
+        Returns the ID of @label_name for @user_email, or None if the label does not exist.
+        """
+        entry = self._entries.get(user_email)
+        if entry is None:
+            entry = await self.refresh(user_email, service)
+        elif label_name not in entry["labels"] and time.monotonic() - entry["loaded_at"] >= self.min_refresh_interval:
+            # The label may have been created outside of this service
+            entry = await self.refresh(user_email, service)
+        else:
+            self._entries.move_to_end(user_email)
+
+        label_id = entry["labels"].get(label_name)
+        if label_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return label_id
+
+    async def get_names(self, user_email: str, service):
+        """
+        Returns the names of all labels of @user_email.
+        """
+        entry = self._entries.get(user_email) or await self.refresh(user_email, service)
+        return set(entry["labels"])
+
+    async def refresh(self, user_email: str, service):
+        """
+        Re-lists the labels of @user_email from Gmail.
+        """
+        response = await gmail_scheduler.execute(service.users().labels().list(userId='me'), user_email)
+        labels = response.get('labels', [])
+        entry = {"labels": {label['name']: label['id'] for label in labels}, "loaded_at": time.monotonic()}
+        self.refreshes += 1
+
+        self._entries[user_email] = entry
+        self._entries.move_to_end(user_email)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def add(self, user_email: str, label_name: str, label_id: str):
+        """
+        Records a newly created label without re-listing.
+        """
+        entry = self._entries.get(user_email)
+        if entry is not None:
+            entry["labels"][label_name] = label_id
+
+    def invalidate(self, user_email: str):
+        self._entries.pop(user_email, None)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+        }
+
+
+label_index = LabelIndex()
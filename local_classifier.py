@@ -0,0 +1,282 @@
+import datetime
+import functools
+import logging
+import random
+import re
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from config import LOCAL_CLASSIFIER_FEATURES, LOCAL_CLASSIFIER_MIN_CONFIDENCE, LOCAL_CLASSIFIER_MIN_SAMPLES, \
+    LOCAL_CLASSIFIER_MIN_CLASS_SAMPLES, LOCAL_CLASSIFIER_AUDIT_RATE, LOCAL_CLASSIFIER_CACHE_SIZE, \
+    LOCAL_CLASSIFIER_SAVE_INTERVAL_SECONDS
+from database import db_classifier_models
+from classification_cache import normalize_text, normalize_sender
+
+_WORD = re.compile(r'[a-z#]{2,}')
+
+
+@functools.lru_cache(maxsize=65536)
+def _hash_token(token: str, n_features: int):
+    return zlib.crc32(token.encode('utf-8')) & (n_features - 1)
+
+
+def hash_features(sender: str, subject: str, snippet: str, n_features: int = LOCAL_CLASSIFIER_FEATURES):
+    """
+    Returns the hashed feature indices of an email: sender address and domain,
+    subject words and word pairs, and snippet words (normalized like the classification cache).
+    """
+    address = normalize_sender(sender)
+    subject_words = _WORD.findall(normalize_text(subject))
+    tokens = [f'a:{address}', f'd:{address.rpartition("@")[2]}']
+    tokens += [f's:{word}' for word in subject_words]
+    tokens += [f'p:{first} {second}' for first, second in zip(subject_words, subject_words[1:])]
+    tokens += [f'b:{word}' for word in _WORD.findall(normalize_text(snippet))]
+    return [_hash_token(token, n_features) for token in tokens]
+
+
+class NaiveBayesModel:
+    """
+    Multinomial naive Bayes over hashed features, trained incrementally.
+    @counts holds one row of feature counts per label in @labels.
+    """
+
+    def __init__(self, n_features: int = LOCAL_CLASSIFIER_FEATURES, labels: list = None, counts=None,
+                 doc_counts=None, alpha: float = 0.1):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.labels = list(labels or [])
+        self.counts = counts if counts is not None else np.zeros((len(self.labels), n_features), dtype=np.float32)
+        self.doc_counts = doc_counts if doc_counts is not None else np.zeros(len(self.labels), dtype=np.float32)
+        self._log_probs = None
+
+    @property
+    def samples(self):
+        return int(self.doc_counts.sum())
+
+    def support(self, label: str):
+        """
+        Returns the number of emails of @label the model was trained on.
+        """
+        return int(self.doc_counts[self.labels.index(label)]) if label in self.labels else 0
+
+    def learn(self, feature_rows: list, labels: list):
+        class_ids = [self._class_id(label) for label in labels]
+        lengths = [len(row) for row in feature_rows]
+        features = np.fromiter((index for row in feature_rows for index in row), dtype=np.int64, count=sum(lengths))
+        np.add.at(self.counts, (np.repeat(class_ids, lengths), features), 1)
+        np.add.at(self.doc_counts, class_ids, 1)
+        self._log_probs = None
+
+    def predict(self, feature_rows: list, allowed_labels: list = None):
+        """
+        Returns the most likely label of each email and its probability among @allowed_labels
+        (all trained labels when not given). Labels the model has not seen yet keep their share:
+        they are scored with smoothed counts, uniform over the features.
+        """
+        label_space = list(self.labels if allowed_labels is None else dict.fromkeys(allowed_labels))
+        if not feature_rows or not label_space:
+            return [(None, 0.0)] * len(feature_rows)
+        class_ids = np.array([self.labels.index(label) if label in self.labels else -1 for label in label_space])
+        seen = class_ids >= 0
+
+        # Sum each email's feature log-probabilities: one gather and one segmented sum for the whole batch
+        lengths = np.fromiter((len(row) for row in feature_rows), dtype=np.int64, count=len(feature_rows))
+        features = np.fromiter((index for row in feature_rows for index in row), dtype=np.int64,
+                               count=int(lengths.sum()))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        scores = np.empty((len(feature_rows), len(label_space)))
+        if seen.any():
+            scores[:, seen] = np.add.reduceat(self._parameters()[np.ix_(features, class_ids[seen])], offsets, axis=0)
+        scores[:, ~seen] = -np.log(self.n_features) * lengths[:, None]
+        doc_counts = np.where(seen, self.doc_counts[np.maximum(class_ids, 0)], 0)
+        scores += np.log((doc_counts + 1) / (doc_counts.sum() + len(label_space)))
+
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        best = probabilities.argmax(axis=1)
+        return [(label_space[index], float(probabilities[row, index])) for row, index in enumerate(best)]
+
+    def to_document(self):
+        return {
+            "labels": self.labels,
+            "features": self.n_features,
+            "counts": zlib.compress(self.counts.tobytes()),
+            "docCounts": self.doc_counts.tolist(),
+        }
+
+    @classmethod
+    def from_document(cls, document: dict):
+        n_features = document["features"]
+        labels = document["labels"]
+        counts = np.frombuffer(zlib.decompress(document["counts"]), dtype=np.float32)
+        return cls(n_features, labels, counts.reshape(len(labels), n_features).copy(),
+                   np.array(document["docCounts"], dtype=np.float32))
+
+    def _class_id(self, label: str):
+        if label not in self.labels:
+            self.labels.append(label)
+            self.counts = np.vstack([self.counts, np.zeros((1, self.n_features), dtype=np.float32)])
+            self.doc_counts = np.append(self.doc_counts, np.float32(0))
+        return self.labels.index(label)
+
+    def _parameters(self):
+        if self._log_probs is None:
+            smoothed = self.counts + self.alpha
+            # Features x labels, so gathering the rows of a batch's features is contiguous
+            self._log_probs = np.ascontiguousarray(
+                (np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))).T)
+        return self._log_probs
+
+
+class LocalClassifier:
+    """
+    Per-user local models that label emails without GPT once they have seen enough GPT decisions.
+    Models are keyed by user and namespace ('label' for incoming mail, 'filter:<label>' for the
+    past email sorter), kept in an LRU of @max_size and persisted to Mongo at most every
+    @save_interval seconds. Predictions are made only by models that have seen at least two
+    of the user's labels, and only for labels seen in @min_class_samples emails.
+    A share @audit_rate of confident predictions is still sent to GPT,
+    and the agreement rate is reported in stats().
+    """
+
+    def __init__(self, collection=db_classifier_models, n_features: int = LOCAL_CLASSIFIER_FEATURES,
+                 min_confidence: float = LOCAL_CLASSIFIER_MIN_CONFIDENCE,
+                 min_samples: int = LOCAL_CLASSIFIER_MIN_SAMPLES,
+                 min_class_samples: int = LOCAL_CLASSIFIER_MIN_CLASS_SAMPLES,
+                 audit_rate: float = LOCAL_CLASSIFIER_AUDIT_RATE, max_size: int = LOCAL_CLASSIFIER_CACHE_SIZE,
+                 save_interval: int = LOCAL_CLASSIFIER_SAVE_INTERVAL_SECONDS):
+        if n_features & (n_features - 1):
+            raise ValueError("The number of features must be a power of two")
+        self.collection = collection
+        self.n_features = n_features
+        self.min_confidence = min_confidence
+        self.min_samples = min_samples
+        self.min_class_samples = min_class_samples
+        self.audit_rate = audit_rate
+        self.max_size = max_size
+        self.save_interval = save_interval
+        self.predicted = 0
+        self.deferred = 0
+        self.audited = 0
+        self.audit_agreements = 0
+        self._models = OrderedDict()
+        self._audits = OrderedDict()
+
+    async def predict(self, user_email: str, namespace: str, labels: list, emails: list):
+        """
+        Returns a label for each (sender, subject, snippet) in @emails the model is confident about, else None.
+        """
+        if not emails:
+            return []
+        entry = await self._entry(f"{namespace}|{user_email}")
+        model = entry["model"]
+        # A model that has seen a single label would give it to every email
+        if model.samples < self.min_samples or sum(model.support(label) > 0 for label in set(labels)) < 2:
+            self.deferred += len(emails)
+            return [None] * len(emails)
+
+        predictions = model.predict([hash_features(*email, self.n_features) for email in emails], labels)
+        results = []
+        for email, (label, confidence) in zip(emails, predictions):
+            if label is None or confidence < self.min_confidence or model.support(label) < self.min_class_samples:
+                self.deferred += 1
+                results.append(None)
+            elif random.random() < self.audit_rate:
+                # Let GPT label it anyway, and compare once the GPT label is learned
+                self._remember_audit((namespace, user_email, *email), label)
+                self.deferred += 1
+                results.append(None)
+            else:
+                self.predicted += 1
+                results.append(label)
+        return results
+
+    async def learn(self, user_email: str, namespace: str, emails: list, labels: list):
+        """
+        Trains the model of @user_email and @namespace on (sender, subject, snippet) @emails
+        and the @labels GPT or the rules gave them. Emails without a label are skipped.
+        """
+        examples = [(email, label) for email, label in zip(emails, labels) if label]
+        if not examples:
+            return
+        for email, label in examples:
+            predicted = self._audits.pop((namespace, user_email, *email), None)
+            if predicted is not None:
+                self.audited += 1
+                self.audit_agreements += predicted == label
+
+        key = f"{namespace}|{user_email}"
+        entry = await self._entry(key)
+        entry["model"].learn([hash_features(*email, self.n_features) for email, _ in examples],
+                             [label for _, label in examples])
+        entry["dirty"] = True
+        if time.monotonic() - entry["saved_at"] >= self.save_interval:
+            await self._save(key, entry)
+
+    async def flush(self):
+        """
+        Persists all models with unsaved training. Called at shutdown.
+        """
+        for key, entry in list(self._models.items()):
+            if entry["dirty"]:
+                await self._save(key, entry)
+
+    def invalidate(self, user_email: str):
+        for key in [key for key in self._models if key.endswith(f"|{user_email}")]:
+            del self._models[key]
+
+    def stats(self):
+        decisions = self.predicted + self.deferred
+        return {
+            "models": len(self._models),
+            "predicted": self.predicted,
+            "deferred": self.deferred,
+            "local_rate": self.predicted / decisions if decisions else 0.0,
+            "audited": self.audited,
+            "audit_accuracy": self.audit_agreements / self.audited if self.audited else 0.0,
+        }
+
+    def _remember_audit(self, key: tuple, label: str):
+        self._audits[key] = label
+        while len(self._audits) > 10000:
+            self._audits.popitem(last=False)
+
+    async def _entry(self, key: str):
+        entry = self._models.get(key)
+        if entry is None:
+            model = None
+            try:
+                document = await self.collection.find_one({"_id": key})
+                if document and document.get("features") == self.n_features:
+                    model = NaiveBayesModel.from_document(document)
+            except Exception as error:
+                logging.error(f"Failed to load classifier model {key}: {error}")
+            entry = {"model": model or NaiveBayesModel(self.n_features), "dirty": False, "saved_at": time.monotonic()}
+            self._models[key] = entry
+            await self._evict()
+        self._models.move_to_end(key)
+        return entry
+
+    async def _evict(self):
+        while len(self._models) > self.max_size:
+            key, entry = self._models.popitem(last=False)
+            if entry["dirty"]:
+                await self._save(key, entry)
+
+    async def _save(self, key: str, entry: dict):
+        entry["dirty"] = False
+        entry["saved_at"] = time.monotonic()
+        document = {**entry["model"].to_document(), "userEmail": key.rpartition("|")[2],
+                    "updatedAt": datetime.datetime.now(datetime.timezone.utc)}
+        try:
+            await self.collection.update_one({"_id": key}, {"$set": document}, upsert=True)
+        except Exception as error:
+            entry["dirty"] = True
+            logging.error(f"Failed to save classifier model {key}: {error}")
+
+
+local_classifier = LocalClassifier()
@@ -2,7 +2,7 @@ from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from routes import app
 
-from config import CORS_ORIGINS
+from config import CORS_ORIGINS, SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_RELOAD
 
 # Set up CORS middleware
 app.add_middleware(
@@ -14,4 +14,6 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+    # Several workers share users through Mongo leases (see coordination.py)
+    uvicorn.run("main:app", host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS,
+                reload=SERVER_RELOAD and SERVER_WORKERS == 1)
@@ -0,0 +1,210 @@
+import bisect
+import contextlib
+import contextvars
+import time
+
+from starlette.routing import Match
+
+from config import METRICS_DEBUG_TIMING
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Route the current task works for, and its per-stage timing breakdown (stage -> [seconds, calls])
+current_route = contextvars.ContextVar("current_route", default="background")
+current_timings = contextvars.ContextVar("current_timings", default=None)
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = ""):
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, label_values: tuple = (), amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus-style histogram with fixed @buckets (upper bounds in seconds).
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, label_values: tuple, value: float):
+        series = self._series.get(label_values)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), sum, count
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, le)} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds the service's metrics and renders them in the Prometheus text exposition format.
+    Besides counters and histograms, components can register a stats() callable whose numeric
+    values are exposed as gauges named @prefix_<key>.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._stats = []
+
+    def counter(self, name: str, documentation: str, label_names: tuple = ()):
+        metric = Counter(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, stats):
+        self._stats.append((prefix, stats))
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        for prefix, stats in self._stats:
+            for key, value in stats().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+stage_duration = metrics_registry.histogram("emailorg_stage_duration_seconds",
+                                            "Time spent in a processing stage", ("route", "stage"))
+stage_errors = metrics_registry.counter("emailorg_stage_errors_total",
+                                        "Processing stages that raised an error", ("route", "stage"))
+request_duration = metrics_registry.histogram("emailorg_http_request_duration_seconds",
+                                              "HTTP request latency", ("route", "method", "status"))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Times the enclosed block as stage @name of the current route.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc((current_route.get(), name))
+        raise
+    finally:
+        elapsed = time.perf_counter() - started_at
+        stage_duration.observe((current_route.get(), name), elapsed)
+        timings = current_timings.get()
+        if timings is not None:
+            timing = timings.setdefault(name, [0.0, 0])
+            timing[0] += elapsed
+            timing[1] += 1
+
+
+@contextlib.contextmanager
+def route_context(route: str):
+    """
+    Attributes the stages of the enclosed block to @route, e.g. for background work.
+    """
+    route_token = current_route.set(route)
+    timings_token = current_timings.set({})
+    try:
+        yield
+    finally:
+        current_route.reset(route_token)
+        current_timings.reset(timings_token)
+
+
+def server_timing(timings: dict):
+    """
+    Formats a timing breakdown as a Server-Timing header value.
+    """
+    return ", ".join(f'{name};dur={seconds * 1000:.1f};desc="{calls} calls"'
+                     for name, (seconds, calls) in timings.items())
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of every HTTP request and scoping stage
+    metrics to its route. With @debug_timing, responses carry a Server-Timing header
+    with the request's per-stage breakdown.
+    """
+
+    def __init__(self, app, debug_timing: bool = METRICS_DEBUG_TIMING):
+        self.app = app
+        self.debug_timing = debug_timing
+        self._routes = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        if self._routes is None:
+            self._routes = {route.path for route in scope["app"].routes}
+        route = scope["path"]
+        if route not in self._routes:
+            # Label paths with parameters by their template; unknown ones share one label
+            # to keep the number of series bounded
+            route = next((candidate.path for candidate in scope["app"].routes
+                          if candidate.matches(scope)[0] == Match.FULL), "other")
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings = current_timings.get()
+                if self.debug_timing and timings:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(timings).encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        started_at = time.perf_counter()
+        with route_context(route):
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                request_duration.observe((route, scope["method"], status), time.perf_counter() - started_at)
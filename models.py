@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 class WebhookData(BaseModel):
     message: dict
@@ -14,10 +14,14 @@ class LabelingRequest(BaseModel):
 
 class PastEmailSort(BaseModel):
     user_email: str
-    sender_email: str
+    # A single sender, and/or a list of senders and domain wildcards ("*@example.com")
+    sender_email: Optional[str] = None
+    sender_emails: List[str] = []
     chosen_labels: List[bool]
     messages_amount: str
 
 class BulkRemove(BaseModel):
     user_email: str
-    sender_email: str
+    sender_email: Optional[str] = None
+    sender_emails: List[str] = []
+    move_to_trash: bool = False
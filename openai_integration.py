@@ -1,43 +1,236 @@
-import openai
-from config import OPENAI_KEY
+import asyncio
+import json
+import logging
+import random
+
+import httpx
+
+from config import OPENAI_KEY, OPENAI_BASE_URL, OPENAI_MODEL, OPENAI_MAX_CONCURRENCY, OPENAI_MAX_CONNECTIONS, \
+    OPENAI_TIMEOUT_SECONDS, OPENAI_MAX_RETRIES, OPENAI_BACKOFF_BASE_SECONDS, OPENAI_BACKOFF_MAX_SECONDS, \
+    OPENAI_CLASSIFY_BATCH_SIZE
+from metrics import stage
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class OpenAIError(Exception):
+    pass
+
+
+class OpenAIClient:
+    """
+    Non-blocking client for the OpenAI chat completions API.
+    All calls share one HTTP connection pool and a global concurrency limit,
+    and are retried with jittered exponential backoff on 429/5xx responses and network errors.
+    """
+
+    def __init__(self, api_key: str = OPENAI_KEY, base_url: str = OPENAI_BASE_URL,
+                 max_concurrency: int = OPENAI_MAX_CONCURRENCY, timeout: float = OPENAI_TIMEOUT_SECONDS,
+                 max_retries: int = OPENAI_MAX_RETRIES):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={'Authorization': f'Bearer {self.api_key}'},
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS)
+            )
+        return self._client
+
+    async def chat(self, messages: list, model: str = OPENAI_MODEL, timeout: float = None, **params):
+        """
+        Sends a chat completion request and returns the content of the first choice.
+        """
+        body = {'model': model, 'messages': messages, **params}
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    with stage('openai.chat'):
+                        response = await self.client.post('/chat/completions', json=body,
+                                                          timeout=timeout or self.timeout)
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        if response.is_error:
+                            raise OpenAIError(f"OpenAI request failed ({response.status_code}): {response.text}")
+                        return response.json()['choices'][0]['message']['content']
+                    error = OpenAIError(f"OpenAI request failed ({response.status_code}): {response.text}")
+                    retry_after = response.headers.get('retry-after')
+                except httpx.TransportError as transport_error:
+                    error = OpenAIError(f"OpenAI request failed: {transport_error!r}")
+
+                if attempt == self.max_retries:
+                    raise error
+                delay = self._backoff(attempt, retry_after)
+                logging.warning(f"{error} - retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after: str = None):
+        try:
+            if retry_after:
+                return min(float(retry_after), OPENAI_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+        return random.uniform(0, min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+openai_client = OpenAIClient()
 
-openai.api_key = OPENAI_KEY
 
 async def gpt_call(labels: list, message_subject: str, message_content: str):
     message = {
         'role': 'user',
         'content': f'''
-        You are a professional email sorter. 
-        I will give you an email subject and content along with a list of labels. 
+        You are a professional email sorter.
+        I will give you an email subject and content along with a list of labels.
         Choose the most appropriate label from the list.
-        
+
         Subject: {message_subject}
         Content: {message_content}
         Labels: {labels}
         '''
     }
-    response = openai.ChatCompletion.create(
-        model='gpt-3.5-turbo',
-        messages=[message]
-    )
-    return response.choices[0].message['content'].strip()
+    response = await openai_client.chat([message])
+    return response.strip()
 
 async def gpt_call_filter_by_sender(label: str, message_subject: str, message_content: str):
     message = {
         'role': 'user',
         'content': f'''
         You are a professional email sorter.
-        I will give you an email subject and content along with a single label. 
+        I will give you an email subject and content along with a single label.
         Determine if the label fits the email.
-        
+
         Subject: {message_subject}
         Content: {message_content}
         Label: {label}
         Respond with 'YES' or 'NO'.
         '''
     }
-    response = openai.ChatCompletion.create(
-        model='gpt-3.5-turbo',
-        messages=[message]
-    )
-    return response.choices[0].message['content'].strip()
+    response = await openai_client.chat([message])
+    return response.strip()
+
+
+async def gpt_call_batch(labels: list, messages: list):
+    """
+    Classifies many emails with one completion per @OPENAI_CLASSIFY_BATCH_SIZE emails.
+    @messages is a list of (subject, content) pairs. Returns the chosen label of each email, in order.
+    Entries the batched answer doesn't cover with a valid label fall back to gpt_call.
+    """
+    instructions = f'''
+        You are a professional email sorter.
+        I will give you a list of emails, each with an id, subject and content, along with a list of labels.
+        Choose the most appropriate label from the list for every email.
+
+        Labels: {labels}
+        '''
+
+    async def fallback(subject, content):
+        return await gpt_call(labels, subject, content)
+
+    return await _classify_batch(instructions, labels, messages, fallback)
+
+
+async def gpt_call_filter_by_sender_batch(label: str, messages: list):
+    """
+    Batched version of gpt_call_filter_by_sender for a list of (subject, content) pairs.
+    Returns 'YES' or 'NO' for each email, in order.
+    """
+    instructions = f'''
+        You are a professional email sorter.
+        I will give you a list of emails, each with an id, subject and content, along with a single label.
+        Determine for every email if the label fits it, answering 'YES' or 'NO'.
+
+        Label: {label}
+        '''
+
+    async def fallback(subject, content):
+        return await gpt_call_filter_by_sender(label, subject, content)
+
+    return await _classify_batch(instructions, ['YES', 'NO'], messages, fallback)
+
+
+async def _classify_batch(instructions: str, allowed_labels: list, messages: list, fallback):
+    chunks = [messages[start:start + OPENAI_CLASSIFY_BATCH_SIZE]
+              for start in range(0, len(messages), OPENAI_CLASSIFY_BATCH_SIZE)]
+    answers = await asyncio.gather(*(_classify_chunk(instructions, allowed_labels, chunk) for chunk in chunks))
+    results = [label for answer in answers for label in answer]
+
+    # Classify entries the batched answers didn't cover one by one, keeping only allowed labels
+    missing = [index for index, label in enumerate(results) if label is None]
+    if missing:
+        logging.warning(f"Falling back to single classification for {len(missing)} of {len(messages)} emails")
+        fallback_labels = await asyncio.gather(*(fallback(*messages[index]) for index in missing),
+                                               return_exceptions=True)
+        for index, label in zip(missing, fallback_labels):
+            if isinstance(label, Exception):
+                logging.error(f"Error classifying email {index}: {label}")
+                label = None
+            elif _canonical_label(label, allowed_labels) is None:
+                logging.warning(f"Unknown label in answer for email {index}: {label!r}")
+            results[index] = _canonical_label(label, allowed_labels)
+    return results
+
+
+async def _classify_chunk(instructions: str, allowed_labels: list, messages: list):
+    emails = '\n'.join(json.dumps({'id': index, 'subject': subject, 'content': content})
+                       for index, (subject, content) in enumerate(messages))
+    message = {
+        'role': 'user',
+        'content': f'''{instructions}
+        Emails (one JSON object per line):
+        {emails}
+
+        Respond only with a JSON array containing one {{"id": <email id>, "label": "<label>"}} object per email.
+        '''
+    }
+    try:
+        answer = await openai_client.chat([message])
+    except Exception as e:
+        logging.error(f"Batched classification failed: {e}")
+        return [None] * len(messages)
+    return _parse_batch_answer(answer, len(messages), allowed_labels)
+
+
+def _parse_batch_answer(answer: str, count: int, allowed_labels: list):
+    """
+    Maps a batched JSON answer to a list of @count labels, with None for missing or invalid entries.
+    """
+    results = [None] * count
+    try:
+        items = json.loads(answer[answer.index('['):answer.rindex(']') + 1])
+    except ValueError:
+        return results
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get('id')
+        label = _canonical_label(item.get('label'), allowed_labels)
+        if isinstance(index, int) and 0 <= index < count and label is not None:
+            results[index] = label
+    return results
+
+
+def _canonical_label(answer, allowed_labels: list):
+    """
+    Returns the label of @allowed_labels that @answer names (ignoring case, spaces and quotes), or None.
+    """
+    if answer is None:
+        return None
+    canonical_labels = {str(label).strip().lower(): label for label in allowed_labels}
+    return canonical_labels.get(str(answer).strip().strip('.\'"').strip().lower())
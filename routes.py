@@ -1,29 +1,92 @@
+import asyncio
 import base64
 import json
+from contextlib import asynccontextmanager
 
+import pymongo.errors
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
 from email_services import *
 from models import WebhookData, LabelUpdate, LabelingRequest, PastEmailSort, BulkRemove
 from database import *
+from credential_cache import credential_cache
+from gmail_service_pool import gmail_service_pool, preload
+from label_index import label_index
+from openai_integration import openai_client
+from webhook_queue import WebhookQueue, QueueFullError
+from jobs import JobManager, JobLimitError
+from coordination import sync_coordinator, sync_leases
+from dedup import dedup_store
+from gmail_scheduler import gmail_scheduler
+from classification_cache import classification_cache
+from rules import rule_engine
+from local_classifier import local_classifier
+from sender_index import sender_index
+from sender_filters import parse_senders
+from metrics import metrics_registry, MetricsMiddleware
+from user_repository import get_user, ensure_indexes
+
+
+webhook_queue = WebhookQueue(process_notifications)
+job_manager = JobManager({"bulk_remove": run_bulk_remove_job, "past_email_sort": run_past_email_sort_job})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    await webhook_queue.start()
+    await sync_coordinator.start(webhook_queue.enqueue)
+    await job_manager.start()
+    # Warm up the Google client libraries in the background instead of on the first request
+    preload_task = asyncio.create_task(asyncio.to_thread(preload))
+    yield
+    await preload_task
+    await sync_coordinator.stop()
+    await webhook_queue.stop()
+    await job_manager.stop()
+    await sender_index.stop()
+    await local_classifier.flush()
+    await openai_client.close()
+    main_cluster.close()
+
 
 # Initialize the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+# Expose the components' counters on /metrics
+for name, component in [("webhook_queue", webhook_queue), ("sync_coordinator", sync_coordinator),
+                        ("sync_leases", sync_leases), ("jobs", job_manager),
+                        ("gmail_scheduler", gmail_scheduler), ("credential_cache", credential_cache),
+                        ("gmail_service_pool", gmail_service_pool),
+                        ("label_index", label_index), ("classification_cache", classification_cache),
+                        ("rule_engine", rule_engine), ("local_classifier", local_classifier),
+                        ("sender_index", sender_index), ("dedup", dedup_store)]:
+    metrics_registry.register_stats(f"emailorg_{name}", component.stats)
+
+
+def request_senders(request_data):
+    """
+    Returns the validated senders of a bulk request, from @sender_email and @sender_emails.
+    """
+    senders = ([request_data.sender_email] if request_data.sender_email else []) + request_data.sender_emails
+    try:
+        return parse_senders(senders)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
 
 
 @app.post('/bulk_remove_mails')
 async def bulk_remove_mails(request_data: BulkRemove):
-    if not request_data.user_email or not request_data.sender_email:
+    sender_emails = request_senders(request_data)
+    if not request_data.user_email or not sender_emails:
         raise HTTPException(status_code=400, detail="User email and sender email are required")
 
     user_email = request_data.user_email
-    sender_email = request_data.sender_email
-    try:
-        await delete_emails_by_sender(user_email, sender_email)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to bulk delete - {e}")
-
-    return {"message": "Delete Ended Successfully!"}
+    job = await submit_job(user_email, "bulk_remove",
+                           {"senders": sender_emails, "move_to_trash": request_data.move_to_trash})
+    return {"message": "Delete started", **job}
 
 
 @app.delete('/delete_account')
@@ -32,11 +95,20 @@ async def delete_account(email: str):
         raise HTTPException(status_code=400, detail="Email is required")
 
     try:
-        account = db_users.find_one({"email": email})
+        account = await get_user(email, ["_id"])
         if account:
             account_id = account["_id"]
-            db_users.delete_one({"_id": account_id})
-            db_accounts.delete_one({"userId": account_id})
+            await db_users.delete_one({"_id": account_id})
+            await db_accounts.delete_one({"userId": account_id})
+            await db_classifier_models.delete_many({"userEmail": email})
+            await db_sender_stats.delete_many({"userEmail": email})
+            await db_jobs.delete_many({"userEmail": email})
+            await db_sender_labels.delete_many({"userEmail": email})
+            credential_cache.invalidate(email)
+            gmail_service_pool.invalidate(email)
+            label_index.invalidate(email)
+            local_classifier.invalidate(email)
+            rule_engine.invalidate(email)
             return {"message": "Account deleted successfully"}
         else:
             raise HTTPException(status_code=500, detail="User not found")
@@ -53,7 +125,7 @@ async def update_labels(request_data: LabelUpdate):
     user_labels = request_data.labels
 
     try:
-        db_users.update_one(
+        await db_users.update_one(
             {'email': user_email},
             {'$set': {'labels': user_labels}},
             upsert=True  # Creates a new document if it doesn't exist
@@ -86,7 +158,8 @@ async def gmail_watch(request_data: LabelingRequest):
 
 @app.post('/past_email_sorter')
 async def past_email_sorter(request_data: PastEmailSort):
-    if not request_data.chosen_labels or not request_data.user_email or not request_data.sender_email:
+    sender_emails = request_senders(request_data)
+    if not request_data.chosen_labels or not request_data.user_email or not sender_emails:
         raise HTTPException(status_code=400, detail="User email, sender email, and labels are required")
 
     # Limited labels
@@ -101,15 +174,60 @@ async def past_email_sorter(request_data: PastEmailSort):
 
     label = labels_span[label_index]
     user_email = request_data.user_email
-    sender_email = request_data.sender_email
-    num_of_messages = request_data.messages_amount
+    try:
+        num_of_messages = int(request_data.messages_amount)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Messages amount must be a number")
+    if not 0 < num_of_messages <= JOBS_MAX_MESSAGES_PER_SENDER:
+        raise HTTPException(status_code=400,
+                            detail=f"Messages amount must be between 1 and {JOBS_MAX_MESSAGES_PER_SENDER}")
+
+    job = await submit_job(user_email, "past_email_sort",
+                           {"senders": sender_emails, "label": label, "messages_amount": num_of_messages})
+    return {"message": "Email filtering started", **job}
+
 
+async def submit_job(user_email: str, kind: str, params: dict):
     try:
-        await filter_emails_by_sender(user_email, sender_email, label, int(num_of_messages))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error filtering emails: {e}")
+        return await job_manager.submit(user_email, kind, params)
+    except JobLimitError as error:
+        raise HTTPException(status_code=429, detail=str(error))
+
+
+@app.get('/jobs')
+async def list_jobs(email: str, limit: int = 20):
+    if not email:
+        raise HTTPException(status_code=400, detail="Email is required")
+    return await job_manager.list_jobs(email, min(max(limit, 1), 100))
+
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str, email: str):
+    job = await job_manager.get(job_id, email)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 
-    return {"message": "Emails filtered successfully!"}
+@app.get('/jobs/{job_id}/events')
+# Streams the job's progress as Server-Sent Events until it is finished
+async def job_events(job_id: str, email: str):
+    if not await job_manager.get(job_id, email):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream():
+        async for job in job_manager.events(job_id, email):
+            yield f"event: {job['status']}\ndata: {json.dumps(job, default=str)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.post('/jobs/{job_id}/cancel')
+async def cancel_job(job_id: str, email: str):
+    job = await job_manager.cancel(job_id, email)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 @app.get('/get_user_data_ai_labeling')
@@ -121,7 +239,7 @@ async def get_user_data(email: str):
 
     try:
         # Retrieve user data from MongoDB based on the provided email
-        user_data = db_users.find_one({'email': email})
+        user_data = await get_user(email, ["labels", "startLabel"])
         if user_data:
             return [user_data["labels"], user_data["startLabel"]]
         else:
@@ -130,7 +248,18 @@ async def get_user_data(email: str):
         raise HTTPException(status_code=500, detail=f"Error retrieving user data: {e}")
 
 
-@app.get('/webhook')
+@app.get('/get_sender_stats')
+# Loads the Dashboard's top senders, to pick targets for bulk removal and sorting
+async def sender_stats(email: str, limit: int = 50, sort_by: str = "count"):
+    if not email:
+        raise HTTPException(status_code=400, detail="Email is required")
+    if sort_by not in ("count", "size", "last_seen"):
+        raise HTTPException(status_code=400, detail="sort_by must be count, size or last_seen")
+
+    return await get_sender_stats(email, min(max(limit, 1), 1000), sort_by)
+
+
+@app.post('/webhook')
 async def webhook(request: WebhookData):
     # Ensure the request message is present
     if not request.message or 'data' not in request.message:
@@ -140,30 +269,44 @@ async def webhook(request: WebhookData):
     # sent by Gmail API when there is a new message or a change to the inbox.
 
     webhook_data = request.message
-    decoded_data = base64.b64decode(webhook_data['message']['data']).decode('utf-8')
-
     try:
+        decoded_data = base64.b64decode(webhook_data['data']).decode('utf-8')
         json_decoded_data = json.loads(decoded_data)
-    except json.JSONDecodeError:
+    except (ValueError, TypeError):
         raise HTTPException(status_code=400, detail="Invalid JSON in webhook data")
 
-    # The historyId is used to track changes in the Gmail account (e.g., new messages)
-    # and this history ID is sent by Gmail API to notify the subscriber of new changes.
-    # Here, we're fetching the historyId and updating the webhook with it.
-    webhook_history_id = fetch_historyId_update_webhook(json_decoded_data)
-
     # Extract the email address from the decoded webhook data.
     webhook_email = json_decoded_data.get("emailAddress")
     if not webhook_email:
         raise HTTPException(status_code=400, detail="Email address not found in webhook data")
-
-    # Once we have the email and history ID, we call the get_email_from_watch function,
-    # which uses the Gmail API to fetch new email data based on the provided webhook
-    # history ID and email address.
+    if not json_decoded_data.get("historyId"):
+        raise HTTPException(status_code=400, detail="History ID not found in webhook data")
+
+    # Pub/Sub delivers at least once - acknowledge redeliveries without processing them again
+    message_id = webhook_data.get('messageId') or webhook_data.get('message_id')
+    dedup_keys = [f"pubsub:{message_id}"] if message_id else []
+    if dedup_keys and not await dedup_store.claim_many(dedup_keys):
+        return {"message": "Duplicate webhook data ignored"}
+
+    # Processing (history sync, GPT calls, labeling) happens in the background so Pub/Sub
+    # gets its acknowledgement right away and doesn't redeliver slow notifications.
+    # A full queue answers 503, which makes Pub/Sub retry later.
+    # The worker owning the user queues it; other workers leave it pending for the owner.
     try:
-        await get_email_from_watch(webhook_email, webhook_history_id)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching emails from watch: {e}")
+        await sync_coordinator.dispatch(webhook_email, json_decoded_data)
+    except (QueueFullError, pymongo.errors.PyMongoError) as e:
+        await dedup_store.release(dedup_keys)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    # Return a response indicating that the webhook data has been queued.
+    return {"message": "Webhook data has been queued"}
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(metrics_registry.expose(), media_type="text/plain; version=0.0.4")
+
 
-    # Return a response indicating that the webhook data has been processed.
-    return {"message": "Webhook data has been processed"}
+@app.get('/webhook_stats')
+async def webhook_stats():
+    return {**webhook_queue.stats(), "gmail": gmail_scheduler.stats()}
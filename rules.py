@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import re
+from collections import OrderedDict
+
+from config import labels_list, rule_sender_domains, rule_receipt_keywords, RULE_LEARN_THRESHOLD, RULE_CACHE_SIZE
+from database import db_sender_labels
+from classification_cache import normalize_sender
+
+RECEIPTS_LABEL = 'Receipts/Invoices'
+NEWSLETTERS_LABEL = 'Newsletters/Subscriptions'
+
+
+class UserRules:
+    """
+    Lookup tables compiled from the built-in rules and the learned senders,
+    restricted to the labels a user has chosen.
+    """
+
+    def __init__(self, labels: list, learned_senders: dict):
+        allowed = set(labels or []) & set(labels_list)
+        self.sender_labels = {sender: label for sender, label in learned_senders.items() if label in allowed}
+        self.domain_labels = {domain: label for label, domains in rule_sender_domains.items() if label in allowed
+                              for domain in domains}
+        self.receipt_pattern = None
+        if RECEIPTS_LABEL in allowed:
+            keywords = '|'.join(re.escape(keyword) for keyword in rule_receipt_keywords)
+            self.receipt_pattern = re.compile(rf'\b(?:{keywords})\b', re.IGNORECASE)
+        self.newsletter_label = NEWSLETTERS_LABEL if NEWSLETTERS_LABEL in allowed else None
+
+
+def match_learned_sender(rules: UserRules, email: dict):
+    return rules.sender_labels.get(email['sender'])
+
+
+def match_sender_domain(rules: UserRules, email: dict):
+    # Check the domain and each parent domain, e.g. mail.paypal.com -> paypal.com
+    parts = email['domain'].split('.')
+    for start in range(len(parts) - 1):
+        label = rules.domain_labels.get('.'.join(parts[start:]))
+        if label:
+            return label
+
+
+def match_receipt_keywords(rules: UserRules, email: dict):
+    if rules.receipt_pattern and rules.receipt_pattern.search(email['subject'] or ''):
+        return RECEIPTS_LABEL
+
+
+def match_list_unsubscribe(rules: UserRules, email: dict):
+    if email['list_unsubscribe']:
+        return rules.newsletter_label
+
+
+DEFAULT_RULES = [match_learned_sender, match_sender_domain, match_receipt_keywords, match_list_unsubscribe]
+
+
+class RuleEngine:
+    """
+    Labels emails deterministically before they reach GPT.
+    Rules are functions of (UserRules, email) returning a label or None, tried in order.
+    Senders that GPT put under the same label @learn_threshold times in a row become rules themselves.
+    """
+
+    def __init__(self, rules: list = None, collection=db_sender_labels, learn_threshold: int = RULE_LEARN_THRESHOLD,
+                 max_size: int = RULE_CACHE_SIZE):
+        self.rules = list(rules or DEFAULT_RULES)
+        self.collection = collection
+        self.learn_threshold = learn_threshold
+        self.max_size = max_size
+        self.matched = 0
+        self.unmatched = 0
+        self._users = OrderedDict()
+
+    def register(self, rule, first: bool = False):
+        """
+        Adds a custom rule, by default after the built-in ones.
+        """
+        if first:
+            self.rules.insert(0, rule)
+        else:
+            self.rules.append(rule)
+
+    async def classify(self, user_email: str, labels: list, emails: list):
+        """
+        Returns a label or None for each (sender, subject, list_unsubscribe) in @emails.
+        """
+        rules = await self._compiled(user_email, labels)
+        results = []
+        for sender, subject, list_unsubscribe in emails:
+            address = normalize_sender(sender)
+            email = {'sender': address, 'domain': address.rpartition('@')[2], 'subject': subject,
+                     'list_unsubscribe': list_unsubscribe}
+            label = next((label for label in (rule(rules, email) for rule in self.rules) if label), None)
+            if label:
+                self.matched += 1
+            else:
+                self.unmatched += 1
+            results.append(label)
+        return results
+
+    async def learn(self, user_email: str, decisions: list):
+        """
+        Records (sender, label) decisions made by GPT for @user_email.
+        """
+        user = await self._load(user_email)
+        updates = {}
+        for sender, label in decisions:
+            address = normalize_sender(sender)
+            if not address or not label:
+                continue
+            current_label, streak = user['senders'].get(address, (None, 0))
+            streak = streak + 1 if current_label == label else 1
+            user['senders'][address] = (label, streak)
+            if streak == self.learn_threshold:
+                user['compiled'] = None
+            updates[address] = (label, streak)
+        if not updates:
+            return
+        try:
+            await asyncio.gather(*(
+                self.collection.update_one({'_id': f'{user_email}|{address}'},
+                                           {'$set': {'userEmail': user_email, 'sender': address, 'label': label,
+                                                     'streak': streak}},
+                                           upsert=True)
+                for address, (label, streak) in updates.items()
+            ))
+        except Exception as error:
+            logging.error(f"Failed to store sender rules for {user_email}: {error}")
+
+    def invalidate(self, user_email: str):
+        """
+        Drops the cached rules of @user_email, e.g. after the account was removed.
+        """
+        self._users.pop(user_email, None)
+
+    def stats(self):
+        total = self.matched + self.unmatched
+        return {
+            "matched": self.matched,
+            "unmatched": self.unmatched,
+            "match_rate": self.matched / total if total else 0.0,
+        }
+
+    async def _compiled(self, user_email: str, labels: list):
+        user = await self._load(user_email)
+        labels_key = tuple(labels or [])
+        if user['compiled'] is None or user['labels'] != labels_key:
+            learned = {sender: label for sender, (label, streak) in user['senders'].items()
+                       if streak >= self.learn_threshold}
+            user['compiled'] = UserRules(labels, learned)
+            user['labels'] = labels_key
+        return user['compiled']
+
+    async def _load(self, user_email: str):
+        user = self._users.get(user_email)
+        if user is None:
+            senders = {}
+            try:
+                projection = {'sender': 1, 'label': 1, 'streak': 1}
+                async for document in self.collection.find({'userEmail': user_email}, projection):
+                    senders[document['sender']] = (document['label'], document['streak'])
+            except Exception as error:
+                logging.error(f"Failed to load sender rules for {user_email}: {error}")
+            user = {'senders': senders, 'labels': None, 'compiled': None}
+            self._users[user_email] = user
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_email)
+        return user
+
+
+rule_engine = RuleEngine()
@@ -0,0 +1,50 @@
+import re
+
+from config import GMAIL_QUERY_MAX_SENDERS
+from classification_cache import normalize_sender
+
+_PATTERN = re.compile(r'^(\*?@[a-z0-9.-]+\.[a-z]{2,}|[^\s@()"{}]+@[a-z0-9.-]+\.[a-z]{2,})$')
+
+
+def parse_senders(senders: list):
+    """
+    Validates and normalizes sender addresses and domain wildcards ("*@example.com" or "@example.com").
+    Returns the unique patterns in order, domains as "@example.com". Raises ValueError on invalid ones.
+    """
+    patterns = []
+    for sender in senders:
+        pattern = (sender or '').strip().lower()
+        if not _PATTERN.match(pattern):
+            raise ValueError(f"Invalid sender {sender!r}")
+        patterns.append(pattern.lstrip('*'))
+    return list(dict.fromkeys(patterns))
+
+
+def sender_queries(patterns: list, max_senders: int = GMAIL_QUERY_MAX_SENDERS):
+    """
+    Combines @patterns into OR'd Gmail searches of at most @max_senders senders each.
+    """
+    queries = []
+    for start in range(0, len(patterns), max_senders):
+        chunk = patterns[start:start + max_senders]
+        queries.append(f"from:{chunk[0]}" if len(chunk) == 1 else f"from:({' OR '.join(chunk)})")
+    return queries
+
+
+def attribute_sender(from_header: str, patterns: list):
+    """
+    Returns the pattern of @patterns a message's From header belongs to: its address, else its domain.
+    Returns None when neither matches, e.g. when Gmail matched the search on the display name.
+    """
+    address = normalize_sender(from_header)
+    if address in patterns:
+        return address
+    domain = f"@{address.rpartition('@')[2]}"
+    return domain if domain in patterns else None
+
+
+def sender_label_name(pattern: str):
+    """
+    Returns the parent label messages of @pattern are sorted under: the address' user part, or the domain.
+    """
+    return pattern[1:] if pattern.startswith('@') else pattern.split('@')[0]
@@ -0,0 +1,233 @@
+import asyncio
+import datetime
+import email.utils
+import logging
+from collections import Counter
+
+import pymongo
+
+from config import SENDER_INDEX_BACKFILL_LIMIT, SENDER_INDEX_BACKFILL_PAGE_SIZE, SENDER_INDEX_STALE_SECONDS, \
+    SENDER_INDEX_RETRY_SECONDS
+from database import db_sender_stats, db_users
+from classification_cache import normalize_sender
+from gmail_batch import batch_get_metadata, get_header, list_message_ids
+from gmail_scheduler import BULK
+from label_index import label_index
+from metrics import stage
+
+SORT_FIELDS = {"count": "count", "size": "sizeEstimate", "last_seen": "lastSeen"}
+
+
+def _label_key(label: str):
+    # Mongo field names cannot contain dots or start with '$'
+    return label.replace('.', '．').replace('$', '＄')
+
+
+def _label_name(key: str):
+    return key.replace('．', '.').replace('＄', '$')
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class SenderIndex:
+    """
+    Per-user statistics of every sender: message count, estimated size, last seen and the
+    labels applied to its messages. Built once per user by a paged metadata backfill
+    (at most @backfill_limit messages, @page_size per round), then kept up to date
+    with $inc updates from the messages the webhook processes. A failed backfill is
+    retried @retry_after seconds later.
+    The backfill state is stored on the user document as senderIndex.
+    """
+
+    def __init__(self, collection=db_sender_stats, users=db_users, backfill_limit: int = SENDER_INDEX_BACKFILL_LIMIT,
+                 page_size: int = SENDER_INDEX_BACKFILL_PAGE_SIZE, stale_after: int = SENDER_INDEX_STALE_SECONDS,
+                 retry_after: int = SENDER_INDEX_RETRY_SECONDS):
+        self.collection = collection
+        self.users = users
+        self.backfill_limit = backfill_limit
+        self.page_size = page_size
+        self.stale_after = stale_after
+        self.retry_after = retry_after
+        self.recorded = 0
+        self.backfilled = 0
+        self._backfills = {}
+
+    async def record(self, user_email: str, messages: list, applied_labels: dict = None):
+        """
+        Adds fetched @messages (metadata with the From header) to the index of @user_email.
+        @applied_labels maps message IDs to the label name given to them.
+        Errors are logged, never raised, so labeling does not depend on the index.
+        """
+        applied_labels = applied_labels or {}
+        senders = {}
+        for message in messages:
+            name, address = email.utils.parseaddr(get_header(message, 'From') or '')
+            address = normalize_sender(address)
+            if not address:
+                continue
+            sender = senders.setdefault(address, {"name": name, "count": 0, "size": 0, "last_seen": None,
+                                                  "labels": Counter()})
+            sender["name"] = sender["name"] or name
+            sender["count"] += 1
+            sender["size"] += int(message.get('sizeEstimate', 0))
+            if message.get('internalDate'):
+                seen = datetime.datetime.fromtimestamp(int(message['internalDate']) / 1000, datetime.timezone.utc)
+                sender["last_seen"] = max(filter(None, [sender["last_seen"], seen]))
+            label = applied_labels.get(message.get('id'))
+            if label:
+                sender["labels"][label] += 1
+
+        def update(address, sender):
+            increments = {"count": sender["count"], "sizeEstimate": sender["size"]}
+            increments.update({f"labels.{_label_key(label)}": count for label, count in sender["labels"].items()})
+            fields = {"userEmail": user_email, "sender": address, "domain": address.rpartition('@')[2]}
+            if sender["name"]:
+                fields["name"] = sender["name"]
+            return self.collection.update_one({"_id": f"{user_email}|{address}"},
+                                              {"$inc": increments, "$set": fields,
+                                               "$max": {"lastSeen": sender["last_seen"] or _now()}}, upsert=True)
+
+        try:
+            with stage('sender_index.record'):
+                await asyncio.gather(*(update(address, sender) for address, sender in senders.items()))
+            self.recorded += sum(sender["count"] for sender in senders.values())
+        except Exception as error:
+            logging.error(f"Failed to update the sender index of {user_email}: {error}")
+
+    async def record_labels(self, user_email: str, sender_email: str, label: str, count: int):
+        """
+        Counts @count messages of an indexed sender as labeled @label.
+        """
+        if not count:
+            return
+        try:
+            await self.collection.update_one({"_id": f"{user_email}|{normalize_sender(sender_email)}"},
+                                             {"$inc": {f"labels.{_label_key(label)}": count}})
+        except Exception as error:
+            logging.error(f"Failed to update the sender index of {user_email}: {error}")
+
+    async def remove_senders(self, user_email: str, patterns: list):
+        """
+        Drops the senders whose messages were all deleted or trashed:
+        addresses, and every sender of the "@domain" patterns.
+        """
+        addresses = [f"{user_email}|{pattern}" for pattern in patterns if not pattern.startswith('@')]
+        domains = [pattern[1:] for pattern in patterns if pattern.startswith('@')]
+        try:
+            if addresses:
+                await self.collection.delete_many({"_id": {"$in": addresses}})
+            if domains:
+                await self.collection.delete_many({"userEmail": user_email, "domain": {"$in": domains}})
+        except Exception as error:
+            logging.error(f"Failed to update the sender index of {user_email}: {error}")
+
+    async def top_senders(self, user_email: str, limit: int = 50, sort_by: str = "count"):
+        """
+        Returns the @limit senders of @user_email with the highest @sort_by ('count', 'size' or 'last_seen').
+        Served by the (userEmail, field) indexes, so it reads only @limit documents.
+        """
+        field = SORT_FIELDS.get(sort_by)
+        if field is None:
+            raise ValueError(f"Unknown sort field {sort_by}")
+        with stage('mongo.sender_stats'):
+            cursor = self.collection.find({"userEmail": user_email}, {"_id": 0, "userEmail": 0})
+            documents = await cursor.sort([(field, pymongo.DESCENDING)]).limit(limit).to_list(length=limit)
+        for document in documents:
+            document["labels"] = {_label_name(key): count for key, count in document.get("labels", {}).items()}
+        return documents
+
+    async def status(self, user_email: str):
+        """
+        Returns the backfill state of @user_email ({"status": "building"|"ready"|"failed"|...}), or None.
+        """
+        user = await self.users.find_one({"email": user_email}, {"senderIndex": 1})
+        return (user or {}).get("senderIndex")
+
+    async def ensure_backfill(self, user_email: str, service_factory):
+        """
+        Starts the backfill of @user_email in the background unless the index is ready, being built,
+        or failed less than @retry_after seconds ago.
+        @service_factory is awaited for the Gmail service. Returns the backfill state.
+        """
+        state = await self.status(user_email)
+        if (state and state.get("status") == "ready") or user_email in self._backfills:
+            return state
+        if state and state.get("status") == "building":
+            started_at = state["startedAt"].replace(tzinfo=datetime.timezone.utc)
+            if (_now() - started_at).total_seconds() < self.stale_after:
+                # Another worker is building it
+                return state
+        if state and state.get("status") == "failed" and state.get("failedAt"):
+            failed_at = state["failedAt"].replace(tzinfo=datetime.timezone.utc)
+            if (_now() - failed_at).total_seconds() < self.retry_after:
+                return state
+
+        task = asyncio.create_task(self._run_backfill(user_email, service_factory))
+        self._backfills[user_email] = task
+        task.add_done_callback(lambda _: self._backfills.pop(user_email, None))
+        return {"status": "building", "startedAt": _now(), "messages": 0}
+
+    async def backfill(self, user_email: str, service):
+        """
+        Rebuilds the index of @user_email from the metadata of its most recent messages.
+        The listing is taken right before the old counts are cleared, so messages the webhook
+        processes afterwards are not in it and are counted once, on top of the backfill.
+        """
+        state = {"status": "building", "startedAt": _now(), "messages": 0}
+        await self.users.update_one({"email": user_email}, {"$set": {"senderIndex": state}})
+        labels = (await label_index.refresh(user_email, service))["labels"]
+        label_names = {label_id: name for name, label_id in labels.items()}
+        message_ids = await list_message_ids(service, user_email, max_results=self.backfill_limit, priority=BULK)
+        await self.collection.delete_many({"userEmail": user_email})
+
+        for start in range(0, len(message_ids), self.page_size):
+            page = await batch_get_metadata(service, user_email, message_ids[start:start + self.page_size],
+                                            headers=['From'], priority=BULK)
+            applied = {}
+            for message_id, message in page.items():
+                # Count the user's own labels only, attributing one per message
+                label = next((label_names[label_id] for label_id in message.get('labelIds', [])
+                              if label_id.startswith('Label_') and label_id in label_names), None)
+                if label:
+                    applied[message_id] = label
+            await self.record(user_email, list(page.values()), applied)
+            self.backfilled += len(page)
+            await self.users.update_one({"email": user_email}, {"$set": {"senderIndex.messages": start + len(page)}})
+
+        await self._set_state(user_email, {"status": "ready", "completedAt": _now(), "messages": len(message_ids)})
+        return len(message_ids)
+
+    async def stop(self):
+        """
+        Cancels running backfills. Called at shutdown; they are restarted on the next request.
+        """
+        tasks = list(self._backfills.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "backfills_running": len(self._backfills),
+            "backfilled_messages": self.backfilled,
+            "recorded_messages": self.recorded,
+        }
+
+    async def _run_backfill(self, user_email: str, service_factory):
+        try:
+            await self.backfill(user_email, await service_factory())
+        except asyncio.CancelledError:
+            await self._set_state(user_email, {"status": "interrupted"})
+            raise
+        except Exception as error:
+            logging.error(f"Sender index backfill of {user_email} failed: {error}")
+            await self._set_state(user_email, {"status": "failed", "error": str(error), "failedAt": _now()})
+
+    async def _set_state(self, user_email: str, state: dict):
+        await self.users.update_one({"email": user_email},
+                                    {"$set": {f"senderIndex.{key}": value for key, value in state.items()}})
+
+
+sender_index = SenderIndex()
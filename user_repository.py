@@ -0,0 +1,56 @@
+import logging
+
+import pymongo
+import pymongo.errors
+
+from database import db_users, db_accounts, db_sender_labels, db_sender_stats
+from metrics import stage
+
+ACCOUNT_FIELDS = ["access_token", "refresh_token", "expires_at"]
+
+
+async def get_user(email: str, fields: list):
+    """
+    Returns only @fields of the user document of @email, or None.
+    """
+    with stage('mongo.get_user'):
+        return await db_users.find_one({"email": email}, {field: 1 for field in fields})
+
+
+async def get_user_with_account(email: str, user_fields: list = None, account_fields: list = ACCOUNT_FIELDS):
+    """
+    Returns the user of @email joined with its account (under "account") in one round-trip,
+    restricted to @user_fields and @account_fields. Returns None if the user doesn't exist.
+    """
+    projection = {field: 1 for field in user_fields or []}
+    projection.update({f"account.{field}": 1 for field in account_fields})
+    pipeline = [
+        {"$match": {"email": email}},
+        {"$limit": 1},
+        {"$lookup": {"from": db_accounts.name, "localField": "_id", "foreignField": "userId", "as": "account"}},
+        {"$set": {"account": {"$arrayElemAt": ["$account", 0]}}},
+        {"$project": projection},
+    ]
+    with stage('mongo.get_user_with_account'):
+        documents = await db_users.aggregate(pipeline).to_list(1)
+    return documents[0] if documents else None
+
+
+async def ensure_indexes():
+    """
+    Creates the indexes the lookups rely on. Called once at startup.
+    """
+    indexes = [
+        (db_users, [("email", pymongo.ASCENDING)], {"unique": True}),
+        (db_accounts, [("userId", pymongo.ASCENDING)], {}),
+        (db_sender_labels, [("userEmail", pymongo.ASCENDING)], {}),
+        # One per sort order of the sender stats endpoint
+        (db_sender_stats, [("userEmail", pymongo.ASCENDING), ("count", pymongo.DESCENDING)], {}),
+        (db_sender_stats, [("userEmail", pymongo.ASCENDING), ("sizeEstimate", pymongo.DESCENDING)], {}),
+        (db_sender_stats, [("userEmail", pymongo.ASCENDING), ("lastSeen", pymongo.DESCENDING)], {}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except pymongo.errors.PyMongoError as error:
+            logging.error(f"Failed to create index {keys} on {collection.name}: {error}")
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from config import WEBHOOK_WORKERS, WEBHOOK_QUEUE_MAX_PENDING, WEBHOOK_DRAIN_TIMEOUT_SECONDS, \
+    WEBHOOK_COALESCE_WINDOW_SECONDS
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class WebhookQueue:
+    """
+    In-process queue of Gmail notifications drained by a pool of @workers tasks.
+    Notifications of the same user that arrive within @coalesce_window seconds are handed
+    to @handler together, as one list in arrival order. A user is handled by one worker
+    at a time, while different users are processed concurrently.
+    """
+
+    def __init__(self, handler, workers: int = WEBHOOK_WORKERS, max_pending: int = WEBHOOK_QUEUE_MAX_PENDING,
+                 coalesce_window: float = WEBHOOK_COALESCE_WINDOW_SECONDS):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.coalesce_window = coalesce_window
+        self.processed = 0
+        self.batches = 0
+        self.failed = 0
+        self.total_lag = 0.0
+        self._pending = {}
+        self._depth = 0
+        self._scheduled = set()
+        self._ready = None
+        self._tasks = []
+        self._closing = False
+        self._idle = None
+
+    def enqueue(self, user_email: str, notification: dict):
+        """
+        Queues @notification for @user_email. Raises QueueFullError when the queue is full or shutting down.
+        """
+        if self._closing or self._ready is None:
+            raise QueueFullError("Webhook queue is not accepting notifications")
+        if self._depth >= self.max_pending:
+            raise QueueFullError(f"Webhook queue is full ({self._depth} pending)")
+
+        self._pending.setdefault(user_email, deque()).append((notification, time.monotonic()))
+        self._depth += 1
+        self._idle.clear()
+        if user_email not in self._scheduled:
+            self._scheduled.add(user_email)
+            self._schedule(user_email)
+
+    async def start(self):
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT_SECONDS):
+        """
+        Stops accepting notifications and waits up to @timeout seconds for queued ones to finish.
+        """
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Webhook queue drain timed out with {self._depth} notifications pending")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        now = time.monotonic()
+        oldest = min((pending[0][1] for pending in self._pending.values() if pending), default=None)
+        return {
+            "depth": self._depth,
+            "users": len(self._scheduled),
+            "oldest_lag_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "processed": self.processed,
+            "batches": self.batches,
+            "failed": self.failed,
+            "average_lag_seconds": round(self.total_lag / self.processed, 3) if self.processed else 0.0,
+        }
+
+    def _schedule(self, user_email: str):
+        """
+        Hands @user_email to the workers once its oldest pending notification is @coalesce_window seconds old.
+        """
+        oldest = self._pending[user_email][0][1]
+        delay = max(0.0, oldest + self.coalesce_window - time.monotonic())
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, user_email)
+
+    async def _worker(self):
+        while True:
+            user_email = await self._ready.get()
+            pending = self._pending[user_email]
+            batch = [pending.popleft() for _ in range(len(pending))]
+            now = time.monotonic()
+            self.total_lag += sum(now - enqueued_at for _, enqueued_at in batch)
+            try:
+                await self.handler(user_email, [notification for notification, _ in batch])
+            except Exception as error:
+                self.failed += len(batch)
+                logging.error(f"Error processing notifications for {user_email}: {error}")
+            finally:
+                self.processed += len(batch)
+                self.batches += 1
+                self._depth -= len(batch)
+                # Notifications that arrived meanwhile form the user's next batch
+                if self._pending[user_email]:
+                    self._schedule(user_email)
+                else:
+                    del self._pending[user_email]
+                    self._scheduled.discard(user_email)
+                if not self._depth:
+                    self._idle.set()